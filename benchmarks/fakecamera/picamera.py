@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A synthetic stand in for the picamera package, used to benchmark the server
+without a Raspberry Pi. Captures return frames of a configurable size after
+a configurable delay, set through the environment:
+
+* ``TWISTEDPI_FAKE_FRAME_SIZE``: Frame size in bytes, default 200000
+* ``TWISTEDPI_FAKE_CAPTURE_DELAY``: Still capture time in seconds, default 0.2
+* ``TWISTEDPI_FAKE_VIDEO_DELAY``: Video port capture time, default 0.03
+* ``TWISTEDPI_FAKE_OPEN_DELAY``: Camera open time, default 1.0
+"""
+
+import os
+import time
+
+
+FRAME_SIZE = int(os.environ.get('TWISTEDPI_FAKE_FRAME_SIZE', 200000))
+CAPTURE_DELAY = float(os.environ.get('TWISTEDPI_FAKE_CAPTURE_DELAY', 0.2))
+VIDEO_DELAY = float(os.environ.get('TWISTEDPI_FAKE_VIDEO_DELAY', 0.03))
+OPEN_DELAY = float(os.environ.get('TWISTEDPI_FAKE_OPEN_DELAY', 1.0))
+
+
+class PiCameraError(Exception):
+    pass
+
+
+class PiCameraValueError(PiCameraError, ValueError):
+    pass
+
+
+def _frame(_size):
+    #JPEG markers around a filler so the data looks roughly like an image
+    return b'\xff\xd8' + b'\x00' * max(_size - 4, 0) + b'\xff\xd9'
+
+
+class PiCamera(object):
+    def __init__(self):
+        time.sleep(OPEN_DELAY)
+
+        self.resolution = (1280, 720)
+        self.ISO = 0
+        self.awb_mode = 'auto'
+        self.brightness = 50
+        self.color_effects = None
+        self.contrast = 0
+        self.crop = (0.0, 0.0, 1.0, 1.0)
+        self.exif_tags = dict()
+        self.exposure_compensation = 0
+        self.exposure_mode = 'auto'
+        self.framerate = 30
+        self.hflip = False
+        self.led = True
+        self.meter_mode = 'average'
+        self.rotation = 0
+        self.saturation = 0
+        self.sharpness = 0
+        self.shutter_speed = 0
+        self.vflip = False
+
+        self.closed = False
+        self._data = _frame(FRAME_SIZE)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def capture(self, output, format=None, use_video_port=False, resize=None,
+                **options):
+        if self.closed:
+            raise PiCameraError('Camera is closed')
+
+        time.sleep(VIDEO_DELAY if use_video_port else CAPTURE_DELAY)
+        output.write(self._data)
+
+    def capture_continuous(self, output, format=None, use_video_port=False,
+                           resize=None, **options):
+        while True:
+            self.capture(output, format, use_video_port, resize, **options)
+            yield output
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator for the twistedpi server.
+
+Runs a set of scenarios against a server and reports requests per second,
+latency percentiles, bytes per second and the peak server memory. Unless a
+port is given, a server is started for the run, using either the fake
+picamera module in ``fakecamera`` or the synthetic camera backend. Results
+are written as JSON and can be compared with an earlier run to catch
+regressions::
+
+    python benchmarks/loadgen.py --output baseline.json
+    python benchmarks/loadgen.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKECAMERA = os.path.join(ROOT, 'benchmarks', 'fakecamera')
+
+#name: (command, args, use all clients)
+SCENARIOS = dict([
+    ('ping', ('PING', dict(), False)),
+    ('image', ('IMAGE', dict(), False)),
+    ('concurrent_ping', ('PING', dict(), True)),
+    ('concurrent_image', ('IMAGE', dict(), True)),
+    ('concurrent_cached_image', ('IMAGE', dict([('max_age', 1.0)]), True)),
+    ('renditions', ('IMAGE', dict([('renditions', [
+        dict(), dict([('resize', [320, 180]), ('quality', 60)])])]), False)),
+])
+
+DEFAULT_SCENARIOS = ['ping', 'image', 'concurrent_ping', 'concurrent_image',
+                     'concurrent_cached_image']
+
+#Scenarios needing the synthetic backend, the fake camera module only
+#produces encoded images and can not serve the raw captures they rely on
+SYNTHETIC_SCENARIOS = ['renditions']
+
+
+class NetstringClient(object):
+    """
+    A minimal blocking client for the netstring/JSON protocol.
+
+    :param _host:
+    :param _port:
+    :param _transport: Response transport to negotiate
+    """
+
+    def __init__(self, _host, _port, _transport='base64'):
+        self.sock = socket.create_connection((_host, _port))
+        self.buffer = b''
+        self.received = 0
+
+        self.handshake = self.read()
+        if _transport != 'base64':
+            self.request('NEGOTIATE', dict([('transport', _transport)]))
+
+    def close(self):
+        self.sock.close()
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise IOError('Connection closed')
+        self.received += len(data)
+        self.buffer += data
+
+    def _readString(self):
+        while not b':' in self.buffer:
+            self._recv()
+
+        length, _, rest = self.buffer.partition(b':')
+        length = int(length)
+        self.buffer = rest
+
+        while len(self.buffer) < length + 1:
+            self._recv()
+
+        data = self.buffer[:length]
+        self.buffer = self.buffer[length + 1:]
+        return data
+
+    def read(self):
+        """
+
+        :return: The next response, binary payloads are read as well
+        """
+        response = json.loads(self._readString().decode('utf-8'))
+        if isinstance(response.get('binary', None), list):
+            response['payload'] = [self._readString()
+                                   for _ in response['binary']]
+        elif 'binary' in response:
+            response['payload'] = self._readString()
+
+        return response
+
+    def request(self, _command, _args):
+        """
+        Send a request and wait for the response.
+
+        :return: The response
+        """
+        data = json.dumps(dict([('command', _command),
+                                ('args', dict(_args))])).encode('utf-8')
+        self.sock.sendall(str(len(data)).encode('ascii') + b':' + data + b',')
+
+        return self.read()
+
+
+def percentile(_values, _percent):
+    if not _values:
+        return None
+
+    index = int(round(_percent / 100.0 * (len(_values) - 1)))
+    return sorted(_values)[index]
+
+
+def rss(_pid):
+    """
+
+    :return: Resident set size of a process in kB, or None if unknown
+    """
+    try:
+        with open('/proc/{0}/status'.format(_pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return None
+
+
+def runScenario(_options, _name, _pid):
+    command, args, concurrent = SCENARIOS[_name]
+    clients = _options.clients if concurrent else 1
+    per_client = max(_options.requests // clients, 1)
+
+    latencies = list()
+    errors = [0]
+    received = [0]
+    lock = threading.Lock()
+
+    def worker():
+        client = NetstringClient(_options.host, _options.port,
+                                 _options.transport)
+        mine = list()
+        failed = 0
+
+        try:
+            for _ in range(per_client):
+                started = time.time()
+                response = client.request(command, args)
+                mine.append(time.time() - started)
+                if 'error' in response:
+                    failed += 1
+        finally:
+            client.close()
+
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+            received[0] += client.received
+
+    peak = [rss(_pid) if _pid else None]
+    done = threading.Event()
+
+    def sampleMemory():
+        while not done.wait(0.1):
+            value = rss(_pid)
+            if value is not None and value > peak[0]:
+                peak[0] = value
+
+    sampler = None
+    if peak[0] is not None:
+        sampler = threading.Thread(target=sampleMemory)
+        sampler.start()
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - started
+
+    done.set()
+    if sampler is not None:
+        sampler.join()
+
+    return dict([('clients', clients), ('requests', len(latencies)),
+                 ('errors', errors[0]), ('duration', duration),
+                 ('requests_per_sec', len(latencies) / duration),
+                 ('bytes_per_sec', received[0] / duration),
+                 ('p50', percentile(latencies, 50)),
+                 ('p95', percentile(latencies, 95)),
+                 ('p99', percentile(latencies, 99)),
+                 ('server_rss_kb', peak[0])])
+
+
+def startServer(_port, _backend):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [FAKECAMERA, ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    server = subprocess.Popen(['twistd', '--nodaemon', '--pidfile=',
+                               'twistedpi', '--port', str(_port),
+                               '--backend', _backend],
+                              env=env, cwd=ROOT)
+
+    #Wait for the server to accept connections and open the camera
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            NetstringClient('127.0.0.1', _port).close()
+            return server
+        except socket.error:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise SystemExit('Server did not start')
+
+
+def compare(_results, _baseline, _tolerance):
+    """
+    Compare results with a baseline.
+
+    :return: A list of regression descriptions
+    """
+    regressions = list()
+
+    for name, result in _results['scenarios'].items():
+        base = _baseline['scenarios'].get(name, None)
+        if base is None:
+            continue
+
+        if result['requests_per_sec'] < base['requests_per_sec'] * (1 - _tolerance):
+            regressions.append('{0}: requests/sec {1:.1f} < {2:.1f}'.format(
+                name, result['requests_per_sec'], base['requests_per_sec']))
+
+        for key in ('p50', 'p95', 'p99'):
+            if result[key] > base[key] * (1 + _tolerance):
+                regressions.append('{0}: {1} {2:.4f}s > {3:.4f}s'.format(
+                    name, key, result[key], base[key]))
+
+    return regressions
+
+
+def report(_results):
+    print('{0:<26}{1:>10}{2:>10}{3:>10}{4:>10}{5:>12}{6:>10}{7:>8}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'MB/s', 'RSS kB',
+        'errors'))
+
+    for name in sorted(_results['scenarios']):
+        r = _results['scenarios'][name]
+        print('{0:<26}{1:>10.1f}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>12.2f}{6:>10}'
+              '{7:>8}'.format(name, r['requests_per_sec'], r['p50'] * 1000,
+                              r['p95'] * 1000, r['p99'] * 1000,
+                              r['bytes_per_sec'] / 1e6,
+                              r['server_rss_kb'] or '-', r['errors']))
+
+    failed = [name for name in sorted(_results['scenarios'])
+              if _results['scenarios'][name]['errors']]
+    if failed:
+        print('Scenarios with failed requests, results are not valid: '
+              '{0}'.format(', '.join(failed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Use a running server instead of starting one')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests per scenario')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Connections in the concurrent scenarios')
+    parser.add_argument('--backend', default='picamera',
+                        choices=['picamera', 'synthetic'],
+                        help='Camera backend of the started server, picamera '
+                             'uses the fake camera module')
+    parser.add_argument('--transport', default='base64',
+                        choices=['base64', 'binary'])
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=sorted(SCENARIOS))
+    parser.add_argument('--output', help='Write the results to a JSON file')
+    parser.add_argument('--compare', help='Baseline results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed relative change before a regression')
+    options = parser.parse_args()
+
+    scenarios = options.scenarios or DEFAULT_SCENARIOS
+    if options.port is None and options.backend != 'synthetic':
+        needing = [name for name in scenarios if name in SYNTHETIC_SCENARIOS]
+        if needing:
+            parser.error('{0} needs --backend synthetic'.format(
+                ', '.join(needing)))
+
+    server = None
+    if options.port is None:
+        options.port = 18090
+        server = startServer(options.port, options.backend)
+
+    try:
+        results = dict([('backend', options.backend),
+                        ('transport', options.transport),
+                        ('clients', options.clients),
+                        ('requests', options.requests),
+                        ('scenarios', dict())])
+
+        for name in scenarios:
+            results['scenarios'][name] = runScenario(
+                options, name, server.pid if server else None)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  options.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,6 @@ from twistedpi import __VERSION__, __NAME__
 
 try:
     import twisted
-    import picamera
 except ImportError:
     raise SystemExit('Required packages not found')
 
@@ -56,10 +55,14 @@ __classifiers__ = [
 ]
 
 __requires__ = [
-    'twisted',
-    'picamera'
+    'twisted'
 ]
 
+#The camera module is only needed by the picamera backend
+__extras__ = {
+    'picamera': ['picamera']
+}
+
 __packages__ = []
 
 __entry_points__ = {}
@@ -92,6 +95,7 @@ setup(
     classifiers=__classifiers__,
     platforms=__platforms__,
     install_requires=__requires__,
+    extras_require=__extras__,
     entry_points=__entry_points__,
 )
 
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Twisted plugin module of the cluster aggregator
+"""
+
+#Zope modules
+from zope.interface import implements
+
+#Twisted modules
+from twisted.python import usage
+from twisted.application.service import IServiceMaker
+from twisted.plugin import IPlugin
+from twisted.application import internet, service
+from twisted.web.server import Site
+
+#twistedpi modules
+from twistedpi import Aggregator, Log, Metrics, Server
+from twistedpi.errors import TwistedPiValueError
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["port", "p", 8091, "Aggregator port number"],
+        ["nodes", "n", None,
+         "Nodes of the cluster as [name=]host:port, ',' separated"],
+        ["node-timeout", None, Aggregator.DEFAULT_TIMEOUT,
+         "Seconds a node has to answer before it is reported as timed out"],
+        ["connections", None, Aggregator.DEFAULT_CONNECTIONS,
+         "Number of persistent connections to every node"],
+        ["encode-threads", None, Server.DEFAULT_ENCODE_THREADS,
+         "Number of threads encoding images"],
+        ["metrics-port", None, None,
+         "Serve Prometheus metrics over HTTP on this port"],
+        ["log-level", None, "info",
+         "Drop log messages below this level: debug, info, warning or error"],
+        ["access-log-sample", None, 0.0,
+         "Fraction of the requests written to the access log"]]
+
+    def postOptions(self):
+        if self["log-level"] not in Log.LEVELS:
+            raise usage.UsageError(
+                "Unknown log level {0}".format(self["log-level"]))
+
+        if self["nodes"] is None:
+            raise usage.UsageError("--nodes is required")
+
+        try:
+            Aggregator.parse_nodes(self["nodes"])
+        except TwistedPiValueError as e:
+            raise usage.UsageError(e.msg)
+
+        if not 0 < float(self["node-timeout"]) <= Aggregator.MAX_TIMEOUT:
+            raise usage.UsageError("--node-timeout must be between 0 and "
+                                   "{0}".format(Aggregator.MAX_TIMEOUT))
+
+
+class AggregatorServiceMaker(object):
+    """
+    Make the service of the cluster aggregator.
+    """
+    implements(IServiceMaker, IPlugin)
+
+    tapname = "twistedpi-aggregator"
+    description = "Service broadcasting captures to many twistedpi servers"
+    options = Options
+
+    def makeService(self, _config):
+        """
+
+        :param _config:
+        :return:
+        """
+        Log.set_level(_config["log-level"])
+        factory = Aggregator.AggregatorFactory(_config)
+
+        top = service.MultiService()
+        internet.TCPServer(int(_config["port"]), factory).setServiceParent(top)
+
+        if _config["metrics-port"] is not None:
+            site = Site(Metrics.MetricsResource(factory.metrics))
+            metrics = internet.TCPServer(int(_config["metrics-port"]), site)
+            metrics.setServiceParent(top)
+
+        return top
+
+
+serviceMaker = AggregatorServiceMaker()
@@ -28,7 +28,8 @@ from zope.interface import implements
 from twisted.python import usage
 from twisted.application.service import IServiceMaker
 from twisted.plugin import IPlugin
-from twisted.application import internet
+from twisted.application import internet, service
+from twisted.web.server import Site
 from twisted.python import log
 
 
@@ -36,14 +37,68 @@ from twisted.python import log
 import logging
 
 #twistedpi modules
-from twistedpi import Server
+from twistedpi import (Backends, Cache, Hub, Log, Metrics, Motion, Recorder,
+                       Scheduler, Server, Timelapse)
 
 __logger = logging.getLogger(__name__)
 
 
 class Options(usage.Options):
     optParameters = [
-        ["port", "p", 8090, "Server port number"]]
+        ["port", "p", 8090, "Server port number"],
+        ["cache-size", None, Cache.DEFAULT_CACHE_SIZE,
+         "Maximum size of the frame cache in bytes"],
+        ["queue-size", None, Scheduler.DEFAULT_QUEUE_SIZE,
+         "Maximum number of captures waiting for the camera"],
+        ["encode-threads", None, Server.DEFAULT_ENCODE_THREADS,
+         "Number of threads encoding images"],
+        ["metrics-port", None, None,
+         "Serve Prometheus metrics over HTTP on this port"],
+        ["backend", "b", Backends.PiCameraBackend.name,
+         "Camera backend: picamera, synthetic or replay"],
+        ["frame-size", None, Backends.DEFAULT_FRAME_SIZE,
+         "Frame size in bytes for the synthetic backend"],
+        ["fps", None, Backends.DEFAULT_FPS,
+         "Maximum frame rate of the synthetic and replay backends"],
+        ["replay-dir", None, None,
+         "Directory with the frames served by the replay backend"],
+        ["profiles", None, None,
+         "JSON file with the capture profiles to define at startup"],
+        ["timelapse-dir", None, None,
+         "Directory of the timelapse frame store"],
+        ["timelapse-interval", None, None,
+         "Capture a timelapse frame every this many seconds"],
+        ["subscriber-queue", None, Hub.DEFAULT_QUEUE_SIZE,
+         "Messages queued for a slow subscriber before the oldest is dropped"],
+        ["feed-fps", None, Hub.DEFAULT_FEED_FPS,
+         "Frame rate of the shared frame feed"],
+        ["motion-interval", None, None,
+         "Sample a frame for motion detection every this many seconds"],
+        ["motion-threshold", None, Motion.DEFAULT_THRESHOLD,
+         "Mean brightness change of a block, 0-255, counting as motion"],
+        ["motion-area", None, Motion.DEFAULT_AREA,
+         "Fraction of the blocks that have to change to report motion"],
+        ["motion-regions", None, None,
+         "Regions of interest as x,y,w,h fractions of the frame, ';' separated"],
+        ["record-seconds", None, None,
+         "Keep this many seconds of H.264 video in memory for clips"],
+        ["record-bitrate", None, Recorder.DEFAULT_BITRATE,
+         "Bitrate of the recorded video"],
+        ["clip-dir", None, None,
+         "Directory receiving clips saved with TRIGGER"],
+        ["log-level", None, "info",
+         "Drop log messages below this level: debug, info, warning or error"],
+        ["access-log-sample", None, 0.0,
+         "Fraction of the requests written to the access log"]]
+
+    def postOptions(self):
+        if self["log-level"] not in Log.LEVELS:
+            raise usage.UsageError(
+                "Unknown log level {0}".format(self["log-level"]))
+
+        if self["timelapse-interval"] is not None and \
+                self["timelapse-dir"] is None:
+            raise usage.UsageError("--timelapse-interval needs --timelapse-dir")
 
 
     def opt_Version(self):
@@ -70,8 +125,31 @@ class ServiceMaker(object):
         :param _config:
         :return:
         """
+        Log.set_level(_config["log-level"])
         factory = Server.ImageServerFactory(_config)
-        return internet.TCPServer(int(_config["port"]), factory)
+
+        top = service.MultiService()
+        internet.TCPServer(int(_config["port"]), factory).setServiceParent(top)
+
+        if _config["metrics-port"] is not None:
+            site = Site(Metrics.MetricsResource(factory.metrics))
+            metrics = internet.TCPServer(int(_config["metrics-port"]), site)
+            metrics.setServiceParent(top)
+
+        factory.feed.setServiceParent(top)
+        if factory.motion is not None:
+            factory.motion.setServiceParent(top)
+        if factory.recorder is not None:
+            factory.recorder.setServiceParent(top)
+
+        if _config["timelapse-interval"] is not None:
+            timelapse = Timelapse.TimelapseService(
+                factory, factory.frame_store,
+                float(_config["timelapse-interval"]))
+            timelapse.setServiceParent(top)
+            factory.metrics.gauge('timelapse', timelapse.stats)
+
+        return top
 
 
 serviceMaker = ServiceMaker()
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Aggregator module
+"""
+
+#Twisted modules
+from twisted.internet.protocol import Factory
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.python.threadpool import ThreadPool
+
+import time
+
+#Camera modules
+import Log
+import Metrics
+import Schema
+from Server import (DEFAULT_ENCODE_THREADS, BinaryPayload,
+                    JSONCommandProtocol, MultiPayload, ThreadPoolStats)
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiValueError
+from twistedpi.client.Common import ConnectionClosed, RequestError
+from twistedpi.client.TwistedClient import ConnectionPool
+
+
+_log = Log.Logger(__name__)
+
+#Default time a node has to answer, in seconds
+DEFAULT_TIMEOUT = 5.0
+
+#Longest timeout a request may ask for, in seconds
+MAX_TIMEOUT = 60.0
+
+#Default number of connections to every node
+DEFAULT_CONNECTIONS = 1
+
+#Node result status
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_TIMEOUT = 'timeout'
+
+#Arguments selecting the nodes of a request, not forwarded to the nodes
+BROADCAST_SCHEMA = dict([
+    ('nodes', Schema.StringList(_nullable=True)),
+    ('timeout', Schema.Number(0, MAX_TIMEOUT)),
+])
+
+
+def parse_nodes(_value):
+    """
+    Parse a node list of ``[name=]host:port`` entries separated by commas.
+    A node without a name is named after its address.
+
+    :param _value: The node list
+    :return: A list of (name, host, port) tuples
+    :raise TwistedPiValueError:
+    """
+    nodes = list()
+    names = set()
+
+    try:
+        for entry in _value.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+
+            name, _, address = entry.rpartition('=')
+            host, port = address.rsplit(':', 1)
+            name = name or address
+
+            if not host or name in names:
+                raise ValueError(entry)
+
+            names.add(name)
+            nodes.append((name, host, int(port)))
+    except (AttributeError, ValueError):
+        raise TwistedPiValueError('Invalid node list {0}'.format(_value),
+                                  ErrorCodes.BAD_DATA)
+
+    if not nodes:
+        raise TwistedPiValueError('Empty node list', ErrorCodes.BAD_DATA)
+
+    return nodes
+
+
+class Node(object):
+    """
+    A twistedpi server reached through a pool of persistent connections.
+
+    :param _name: Name of the node
+    :param _host:
+    :param _port:
+    """
+
+    def __init__(self, _name, _host, _port):
+        self.name = _name
+        self.host = _host
+        self.port = _port
+        self.pool = None
+
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def connect(self, _connections, _reactor=reactor):
+        """
+        Open the connections to the node, they reconnect when lost.
+
+        :param _connections: Number of connections
+        :param _reactor:
+        """
+        if self.pool is None:
+            self.pool = ConnectionPool(self.host, self.port, _connections,
+                                       _reactor)
+
+    def close(self):
+        """
+        Close the connections to the node.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    @property
+    def connected(self):
+        """
+        True if at least one connection to the node is ready.
+        """
+        return self.pool is not None and any(
+            [factory.client is not None for factory in self.pool.factories])
+
+    def stats(self):
+        """
+
+        :return: A dictionary with the connection state and request counts
+        """
+        return dict([('connected', int(self.connected)),
+                     ('requests', self.requests), ('errors', self.errors),
+                     ('timeouts', self.timeouts)])
+
+    def describe(self):
+        """
+
+        :return: A dictionary describing the node
+        """
+        description = self.stats()
+        description['address'] = '{0}:{1}'.format(self.host, self.port)
+        description['connected'] = self.connected
+        return description
+
+
+class Aggregator(object):
+    """
+    Send a request to many nodes in parallel and report every answer as it
+    arrives. Every node has its own timeout, a node that does not answer in
+    time is reported as timed out without holding up the other nodes.
+
+    :param _nodes: A list of (name, host, port) tuples
+    :param _timeout: Default time a node has to answer, in seconds
+    :param _connections: Number of connections to every node
+    :param _reactor:
+    """
+
+    def __init__(self, _nodes, _timeout=DEFAULT_TIMEOUT,
+                 _connections=DEFAULT_CONNECTIONS, _reactor=reactor):
+        self.timeout = _timeout
+        self.connections = _connections
+        self.reactor = _reactor
+
+        self.nodes = [Node(name, host, port) for name, host, port in _nodes]
+        self._byName = dict([(node.name, node) for node in self.nodes])
+
+    def connect(self):
+        """
+        Open the connections to every node.
+        """
+        for node in self.nodes:
+            node.connect(self.connections, self.reactor)
+
+    def close(self):
+        """
+        Close the connections to every node.
+        """
+        for node in self.nodes:
+            node.close()
+
+    def select(self, _names=None):
+        """
+
+        :param _names: A list of node names, or None for every node
+        :return: A list of Nodes
+        :raise TwistedPiValueError:
+        """
+        if _names is None:
+            return list(self.nodes)
+
+        if not isinstance(_names, list) or not _names:
+            raise TwistedPiValueError('Invalid nodes', ErrorCodes.BAD_REQUEST)
+
+        try:
+            return [self._byName[name] for name in _names]
+        except (KeyError, TypeError):
+            raise TwistedPiValueError('Unknown node', ErrorCodes.BAD_REQUEST)
+
+    def broadcast(self, _command, _args, _nodes, _onResult, _timeout=None):
+        """
+        Send a request to nodes in parallel.
+
+        :param _command:
+        :param _args:
+        :param _nodes: The Nodes receiving the request
+        :param _onResult: Called with the node and its result as soon as the
+                          node answers, fails or times out. The result is a
+                          tuple of status, response or error code, and the
+                          time taken. May return a Deferred, the broadcast
+                          is only done once it has fired.
+        :param _timeout: Time every node has to answer, or None for the
+                         default
+        :return: A Deferred firing with the number of nodes by status
+        """
+        timeout = self.timeout if _timeout is None else _timeout
+
+        summary = dict([(STATUS_OK, 0), (STATUS_ERROR, 0),
+                        (STATUS_TIMEOUT, 0)])
+
+        def nodeDone(_result, _node):
+            status = _result[0]
+            summary[status] += 1
+            return _onResult(_node, _result)
+
+        requests = list()
+        for node in _nodes:
+            d = self._request(node, _command, _args, timeout)
+            d.addCallback(nodeDone, node)
+            requests.append(d)
+
+        d = DeferredList(requests, consumeErrors=True)
+        d.addCallback(lambda _: summary)
+        return d
+
+    def _request(self, _node, _command, _args, _timeout):
+        #Fires with the result of a single node, never fails
+        result = Deferred()
+        started = time.time()
+
+        def timedOut():
+            _node.timeouts += 1
+            result.callback((STATUS_TIMEOUT, None, time.time() - started))
+            d.cancel()
+
+        call = self.reactor.callLater(_timeout, timedOut)
+
+        def answered(_response):
+            if call.active():
+                call.cancel()
+                result.callback((STATUS_OK, _response, time.time() - started))
+
+        def failed(_failure):
+            if not call.active():
+                return
+
+            code = ErrorCodes.SERVER_ERROR
+            if _failure.check(RequestError):
+                code = _failure.value.code
+            elif not _failure.check(ConnectionClosed):
+                _log.error('Request to {0} failed: {1}', _node.name,
+                           _failure.value)
+
+            call.cancel()
+            _node.errors += 1
+            result.callback((STATUS_ERROR, code, time.time() - started))
+
+        _node.requests += 1
+
+        #The node's timeout applies, the request is abandoned when it expires
+        d = _node.pool.request(_command, dict(_args), _timeout=None)
+        d.addCallbacks(answered, failed)
+
+        return result
+
+
+class AggregatorProtocol(JSONCommandProtocol):
+    """
+    Accepts the requests of a twistedpi server and broadcasts them to the
+    nodes of the cluster. A request may select nodes by name in ``nodes``
+    and change the time every node has to answer with ``timeout``, the other
+    arguments are forwarded to the nodes.
+
+    Every node result is sent as soon as it arrives, as a response to the
+    request holding the ``node`` name, the ``status`` (ok, error or
+    timeout), the ``time`` taken and the payload of the node, or the error
+    ``code``. The final response holds the number of nodes by status.
+    """
+
+    def _broadcast(self, _command, _args):
+        Schema.validate(BROADCAST_SCHEMA, _args, ErrorCodes.BAD_REQUEST)
+
+        aggregator = self.factory.aggregator
+        nodes = aggregator.select(_args.pop('nodes', None))
+        timeout = _args.pop('timeout', None)
+
+        request_id = self.current_id
+
+        def nodeResult(_node, _result):
+            return self.sendNodeResult(_command, _node, _result, request_id)
+
+        return aggregator.broadcast(_command, _args, nodes, nodeResult,
+                                    timeout)
+
+    def sendNodeResult(self, _command, _node, _result, _id=None):
+        """
+        Send the result of a single node to the client.
+
+        :param _command: The broadcast command
+        :param _node: The Node
+        :param _result: Status, response or error code, and time taken
+        :param _id: Id of the broadcast request
+        :return: A Deferred firing once the result has been sent, or None
+        """
+        status, value, duration = _result
+
+        response = dict([('command', _command), ('node', _node.name),
+                         ('status', status), ('time', duration)])
+        if _id is not None:
+            response['id'] = _id
+
+        if status == STATUS_ERROR:
+            response['code'] = value
+        elif status == STATUS_OK:
+            response['payload'] = self._nodePayload(value)
+
+        self.factory.metrics.increment('node_results',
+                                       _labels=dict([('status', status)]))
+
+        return self._finalizeRequest(response)
+
+    def _nodePayload(self, _response):
+        payload = _response.get('payload', None)
+        if not 'binary' in _response:
+            return payload
+
+        #Raw data from the node, send it with the transport of this client
+        settings = _response.get('settings', None)
+        if isinstance(payload, list):
+            return MultiPayload([BinaryPayload(data) for data in payload],
+                                settings)
+
+        return BinaryPayload(payload, settings)
+
+    def handle_NODES(self, _args):
+        """
+        List the nodes of the cluster with their connection state and
+        request counts.
+
+        :param _args:
+        :return:
+        """
+        _log.debug('handle_NODES')
+
+        return dict([(node.name, node.describe())
+                     for node in self.factory.aggregator.nodes])
+
+    def handle_PING(self, _args):
+        """
+        Ping the nodes.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_PING')
+        return self._broadcast('PING', _args)
+
+    def handle_IMAGE(self, _args):
+        """
+        Capture an image on the nodes, accepts the arguments of IMAGE.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_IMAGE')
+        return self._broadcast('IMAGE', _args)
+
+    def handle_METRICS(self, _args):
+        """
+        Collect the metrics of the nodes.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_METRICS')
+        return self._broadcast('METRICS', _args)
+
+
+class AggregatorFactory(Factory):
+    """
+    Serve aggregator connections and keep the connections to the nodes.
+
+    :param _config: The aggregator options
+    """
+
+    def __init__(self, _config):
+        _log.debug('Creating Aggregator Factory')
+
+        self.encode_pool = ThreadPool(
+            1, int(_config.get('encode-threads', DEFAULT_ENCODE_THREADS)),
+            'twistedpi-encode')
+
+        self.metrics = Metrics.MetricsRegistry()
+        self.access_log = Log.AccessLog(float(_config.get('access-log-sample',
+                                                          0.0)))
+        self.connections = 0
+
+        self.aggregator = Aggregator(
+            parse_nodes(_config['nodes']),
+            float(_config.get('node-timeout', DEFAULT_TIMEOUT)),
+            int(_config.get('connections', DEFAULT_CONNECTIONS)))
+
+        self.metrics.gauge('connections_open', lambda: self.connections)
+        self.metrics.gauge('pool', lambda: dict([
+            ('encode', ThreadPoolStats(self.encode_pool))]))
+        self.metrics.gauge('node', lambda: dict([
+            (node.name, node.stats()) for node in self.aggregator.nodes]),
+            _label='node')
+
+    def startFactory(self):
+        """
+        Connect to the nodes.
+        """
+        _log.debug('AggregatorFactory.startFactory...')
+
+        self.encode_pool.start()
+        self.aggregator.connect()
+
+    def stopFactory(self):
+        """
+        Disconnect from the nodes.
+        """
+        _log.debug('AggregatorFactory.stopFactory...')
+
+        self.aggregator.close()
+        self.encode_pool.stop()
+
+    def encode(self, _function, *_args):
+        """
+        Run a CPU bound encoding in the encode pool.
+
+        :param _function:
+        :param _args:
+        :return: A Deferred firing with the result
+        """
+        return threads.deferToThreadPool(reactor, self.encode_pool,
+                                         _function, *_args)
+
+    def buildProtocol(self, _addr):
+        """
+
+        :param _addr:
+        :return:
+        """
+        _log.debug('Creating Protocol for {0}', _addr)
+
+        return AggregatorProtocol(self)
+
+    def connectionMade(self):
+        """
+        Called by a protocol when its connection is made.
+        """
+        self.connections += 1
+        self.metrics.increment('connections')
+
+    def connectionLost(self):
+        """
+        Called by a protocol when its connection is lost.
+        """
+        self.connections -= 1
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Camera backend module
+"""
+
+import os
+import struct
+import time
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException, TwistedPiValueError
+from Log import Logger
+from Renditions import raw_resolution
+
+
+#Defaults for the synthetic backend
+DEFAULT_FRAME_SIZE = 200000
+DEFAULT_FPS = 90
+
+#Bytes per pixel of the raw capture formats
+RAW_FORMATS = dict([('yuv', 1.5), ('rgb', 3), ('bgr', 3), ('rgba', 4),
+                    ('bgra', 4)])
+
+_log = Logger(__name__)
+
+
+class CameraBackend(object):
+    """
+    A source of cameras for the camera session.
+
+    ``open`` returns a camera implementing the subset of the
+    ``picamera.PiCamera`` interface used by the server: the settings
+    attributes, ``exif_tags``, ``capture``, ``capture_continuous`` and
+    ``close``. Invalid settings or capture arguments raise a ``ValueError``,
+    like ``picamera.PiCameraValueError`` does.
+
+    Backends able to record video also provide the circular buffer the
+    camera records into.
+    """
+    name = None
+
+    def open(self):
+        """
+
+        :return: An open camera
+        """
+        raise NotImplementedError
+
+    def circular_buffer(self, _camera, _seconds, _bitrate, _splitterPort):
+        """
+
+        :param _camera: An open camera
+        :param _seconds: Length of the buffer, in seconds
+        :param _bitrate: Bitrate of the recorded video
+        :param _splitterPort: The splitter port recorded from
+        :return: A stream keeping only the most recent video
+        :raise TwistedPiException:
+        """
+        raise TwistedPiException('Recording is not supported by the {0} '
+                                 'backend'.format(self.name),
+                                 ErrorCodes.BAD_REQUEST)
+
+    def copy_buffer(self, _buffer, _seconds, _output):
+        """
+        Copy the most recent video from a circular buffer, starting at a key
+        frame.
+
+        :param _buffer: A buffer returned by circular_buffer
+        :param _seconds: Length of the video to copy, in seconds
+        :param _output: A stream receiving the video
+        """
+        raise NotImplementedError
+
+
+class PiCameraBackend(CameraBackend):
+    """
+    The Raspberry Pi camera module.
+    """
+    name = 'picamera'
+
+    def __init__(self):
+        #Only import picamera when it is actually used
+        try:
+            import picamera
+        except ImportError:
+            raise TwistedPiException('picamera is not installed',
+                                     ErrorCodes.SERVER_ERROR)
+        self._picamera = picamera
+
+    def open(self):
+        return self._picamera.PiCamera()
+
+    def circular_buffer(self, _camera, _seconds, _bitrate, _splitterPort):
+        return self._picamera.PiCameraCircularIO(_camera, seconds=_seconds,
+                                                 bitrate=_bitrate,
+                                                 splitter_port=_splitterPort)
+
+    def copy_buffer(self, _buffer, _seconds, _output):
+        _buffer.copy_to(_output, seconds=_seconds)
+
+
+class SyntheticCamera(object):
+    """
+    A camera producing generated frames of a fixed size at a fixed rate.
+    Every frame starts with a JPEG start of image marker and a frame counter
+    and ends with an end of image marker.
+
+    :param _frameSize: Frame size in bytes
+    :param _fps: Frame rate, captures are paced to it
+    """
+
+    def __init__(self, _frameSize, _fps):
+        self.frame_size = max(_frameSize, 16)
+        self.interval = 1.0 / _fps
+
+        self.resolution = (1280, 720)
+        self.ISO = 0
+        self.awb_mode = 'auto'
+        self.brightness = 50
+        self.color_effects = None
+        self.contrast = 0
+        self.crop = (0.0, 0.0, 1.0, 1.0)
+        self.exif_tags = dict()
+        self.exposure_compensation = 0
+        self.exposure_mode = 'auto'
+        self.hflip = False
+        self.led = False
+        self.meter_mode = 'average'
+        self.rotation = 0
+        self.saturation = 0
+        self.sharpness = 0
+        self.shutter_speed = 0
+        self.vflip = False
+
+        self.frames = 0
+        self._filler = b'\x00' * (self.frame_size - 14)
+        self._raw = b''
+        self._next = time.time()
+
+    def _nextFrame(self):
+        #Pace the frames as a real sensor would
+        delay = self._next - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._next = max(self._next, time.time()) + self.interval
+
+        self.frames += 1
+        return (b'\xff\xd8' + struct.pack('>Q', self.frames) + self._filler +
+                b'\x00\x00\xff\xd9')
+
+    def _rawFrame(self, _resolution, _depth):
+        #A black frame with the padded size of a real raw capture
+        width, height = raw_resolution(_resolution)
+        size = int(width * height * _depth)
+
+        if len(self._raw) != size:
+            self._raw = b'\x00' * size
+
+        return self._raw
+
+    def capture(self, output, format='jpeg', use_video_port=False,
+                resize=None, **options):
+        frame = self._nextFrame()
+        if format in RAW_FORMATS:
+            frame = self._rawFrame(resize or self.resolution,
+                                   RAW_FORMATS[format])
+
+        output.write(frame)
+
+    def capture_continuous(self, output, format='jpeg', use_video_port=False,
+                           resize=None, **options):
+        while True:
+            self.capture(output, format, use_video_port, resize, **options)
+            yield output
+
+    def close(self):
+        pass
+
+
+class SyntheticBackend(CameraBackend):
+    """
+    Generated frames, for load testing without camera hardware.
+
+    :param _frameSize: Frame size in bytes
+    :param _fps: Maximum frame rate
+    """
+    name = 'synthetic'
+
+    def __init__(self, _frameSize=DEFAULT_FRAME_SIZE, _fps=DEFAULT_FPS):
+        self.frame_size = _frameSize
+        self.fps = _fps
+
+    def open(self):
+        return SyntheticCamera(self.frame_size, self.fps)
+
+
+class ReplayCamera(SyntheticCamera):
+    """
+    A camera serving recorded frames in a loop.
+
+    :param _frames: A list with the frame data
+    :param _fps: Frame rate, captures are paced to it
+    """
+
+    def __init__(self, _frames, _fps):
+        SyntheticCamera.__init__(self, 0, _fps)
+        self._frames = _frames
+
+    def _nextFrame(self):
+        SyntheticCamera._nextFrame(self)
+        return self._frames[(self.frames - 1) % len(self._frames)]
+
+
+class ReplayBackend(CameraBackend):
+    """
+    Recorded frames read from a directory, served in file name order.
+
+    :param _directory: Directory holding one file per frame
+    :param _fps: Maximum frame rate
+    :raise TwistedPiValueError:
+    """
+    name = 'replay'
+
+    def __init__(self, _directory, _fps=DEFAULT_FPS):
+        if not _directory or not os.path.isdir(_directory):
+            raise TwistedPiValueError('Replay directory not found',
+                                      ErrorCodes.BAD_DATA)
+
+        self.directory = _directory
+        self.fps = _fps
+
+    def open(self):
+        frames = list()
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as frame:
+                    frames.append(frame.read())
+
+        if not frames:
+            raise TwistedPiValueError('No frames to replay',
+                                      ErrorCodes.BAD_DATA)
+
+        _log.debug('Replaying {0} frames', len(frames))
+        return ReplayCamera(frames, self.fps)
+
+
+BACKENDS = dict([(backend.name, backend) for backend in
+                 (PiCameraBackend, SyntheticBackend, ReplayBackend)])
+
+
+def create_backend(_config):
+    """
+    Create the camera backend selected in the configuration.
+
+    :param _config: The server options
+    :return: A CameraBackend
+    :raise TwistedPiValueError:
+    """
+    name = _config.get('backend', PiCameraBackend.name)
+
+    if name == SyntheticBackend.name:
+        return SyntheticBackend(
+            int(_config.get('frame-size', DEFAULT_FRAME_SIZE)),
+            float(_config.get('fps', DEFAULT_FPS)))
+    if name == ReplayBackend.name:
+        return ReplayBackend(_config.get('replay-dir', None),
+                             float(_config.get('fps', DEFAULT_FPS)))
+    if name == PiCameraBackend.name:
+        return PiCameraBackend()
+
+    raise TwistedPiValueError('Unknown camera backend {0}'.format(name),
+                              ErrorCodes.BAD_REQUEST)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache module
+"""
+
+from collections import OrderedDict
+import time
+
+#twistedpi modules
+from Log import Logger
+
+
+#Default upper limit for the total size of all cached frames
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+
+_log = Logger(__name__)
+
+
+class FrameCache(object):
+    """
+    A size limited LRU cache of recently captured frames.
+
+    Frames are keyed by their normalized capture arguments. A lookup states
+    how old a frame it is willing to accept, so clients that can live with a
+    slightly old frame do not have to wait for the camera.
+
+    :param _max_bytes: Upper limit for the total size of all cached frames
+    """
+
+    def __init__(self, _max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = _max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, _key, _max_age):
+        """
+        Look up a frame.
+
+        :param _key: Normalized capture arguments
+        :param _max_age: Oldest acceptable frame, in seconds
+        :return: The cached frame or None
+        """
+        entry = self._entries.pop(_key, None)
+
+        if entry is not None:
+            #Reinsert to mark the frame as most recently used
+            self._entries[_key] = entry
+
+            timestamp, frame = entry
+            if time.time() - timestamp <= _max_age:
+                self.hits += 1
+                return frame
+
+        self.misses += 1
+        return None
+
+    def put(self, _key, _frame, _timestamp=None):
+        """
+        Store a frame, evicting the least recently used frames if the cache
+        grows too large.
+
+        :param _key: Normalized capture arguments
+        :param _frame: The frame, anything with a length in bytes
+        :param _timestamp: Capture time, defaults to now
+        """
+        if _timestamp is None:
+            _timestamp = time.time()
+
+        self.discard(_key)
+
+        if len(_frame) > self.max_bytes:
+            _log.debug('Frame too large to cache')
+            return
+
+        self._entries[_key] = (_timestamp, _frame)
+        self.size += len(_frame)
+
+        while self.size > self.max_bytes:
+            _, (_, frame) = self._entries.popitem(last=False)
+            self.size -= len(frame)
+            self.evictions += 1
+
+    def discard(self, _key):
+        """
+        Remove a frame from the cache if present.
+
+        :param _key: Normalized capture arguments
+        """
+        entry = self._entries.pop(_key, None)
+
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        """
+        Remove all frames from the cache.
+        """
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+
+        :return: A dictionary with cache statistics
+        """
+        return dict([('entries', len(self._entries)), ('bytes', self.size),
+                     ('max_bytes', self.max_bytes), ('hits', self.hits),
+                     ('misses', self.misses), ('evictions', self.evictions)])
@@ -24,131 +24,538 @@ Camera module
 from twisted.python import log
 
 import threading
-import logging
+import time
 import io
 
-import picamera
-
 from errors import ErrorCodes, TwistedPiValueError, TwistedPiException
+from Log import Logger
+from Metrics import MetricsRegistry
+import Schema
+
 
+_log = Logger(__name__)
 
-__lock = threading.Lock()
-__log = logging.getLogger(__name__)
+#Camera settings accepted as image arguments, in the order they are applied.
+#Changing the resolution reconfigures the whole pipeline so it goes first.
+CAMERA_SETTINGS = (
+    'resolution',
+    'ISO',
+    'awb_mode',
+    'brightness',
+    'color_effects',
+    'contrast',
+    'crop',
+    'exposure_compensation',
+    'exposure_mode',
+    'hflip',
+    'led',
+    'meter_mode',
+    'rotation',
+    'saturation',
+    'sharpness',
+    'shutter_speed',
+    'vflip',
+)
+
+#Camera settings that can be set but not read back, they are only applied
+#when a request sets them and are not reset to a default
+WRITE_ONLY_SETTINGS = frozenset(['led'])
 
 
 def validate_image_args(_args):
     """
-    Validate the camera arguments. Ensures that a camera format is provided.
+    Validate the camera arguments against the image schema. Runs before the
+    capture is scheduled so that invalid requests never wait for the camera.
+    Ensures that a camera format is provided.
 
     :param _args:
     :return: A dictionary of validated arguments
+    :raise TwistedPiValueError:
     """
+    Schema.validate(Schema.IMAGE_SCHEMA, _args)
+
     if not 'format' in _args:
         _args['format'] = 'jpeg'  # Default to jpeg if format is missing
 
     return _args
 
 
-def take_image(_args):
+def read_settings(_camera):
+    """
+    Read the current value of every camera setting that can be read.
+
+    :param _camera: An open camera
+    :return: A dictionary of settings
+    """
+    return dict([(name, _setting_value(getattr(_camera, name)))
+                 for name in CAMERA_SETTINGS
+                 if not name in WRITE_ONLY_SETTINGS])
+
+
+def _setting_value(_value):
+    #Sequences arrive as JSON lists but are read back from the camera as
+    #tuples, make them comparable.
+    if isinstance(_value, (list, tuple)):
+        return tuple(_value)
+
+    return _value
+
+
+def compile_settings(_args):
+    """
+    Compile the camera settings found in the provided arguments into an
+    apply plan, the settings in the order they are applied.
+
+    :param _args:
+    :return: A tuple of (name, value) pairs
+    """
+    return tuple([(name, _setting_value(_args[name]))
+                  for name in CAMERA_SETTINGS if name in _args])
+
+
+def configure_camera(_camera, _args, _settings, _plan=None, _defaults=None):
+    """
+    Apply the camera settings found in the provided arguments on top of the
+    camera defaults, settings the arguments leave out are reset to their
+    default, except for write only settings. Only settings that differ from the currently applied ones are
+    touched, every change may cause the camera to reconfigure its pipeline.
+
+    :param _camera: An open camera
+    :param _args:
+    :param _settings: The currently applied settings, updated in place
+    :param _plan: The settings compiled with compile_settings, compiled from
+                  the arguments if not given
+    :param _defaults: The settings of a freshly opened camera, read with
+                      read_settings, and its EXIF tags in ``exif_tags``
+    :return: A list with the names of the changed settings
+    :raise TwistedPiValueError:
+    """
+    if _plan is None:
+        _plan = compile_settings(_args)
+
+    target = dict(_defaults or ())
+    target.update(_plan)
+
+    changed = list()
+
+    try:
+        for name in CAMERA_SETTINGS:
+            if not name in target:
+                continue
+
+            value = target[name]
+            if not name in _settings or _settings[name] != value:
+                setattr(_camera, name, value)
+                _settings[name] = value
+                changed.append(name)
+
+        if _defaults is not None:
+            _camera.exif_tags.clear()
+            _camera.exif_tags.update(_defaults.get('exif_tags', ()))
+
+        if 'exif_tags' in _args:
+            for k, v in _args['exif_tags'].items():
+                _camera.exif_tags[k] = v
+
+    except ValueError:
+        raise TwistedPiValueError('Invalid Camera Arguments',
+                                  ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+    if changed:
+        _log.debug('Changed camera settings: {0}', ', '.join(changed))
+
+    return changed
+
+
+def capture_settings(_settings, _args):
+    """
+    Create a snapshot of the settings in effect for a capture.
+
+    :param _settings: The currently applied camera settings
+    :param _args:
+    :return: A dictionary of settings
+    """
+    settings = dict(_settings)
+
+    settings['format'] = _args.get('format', 'jpeg')
+    settings['resize'] = _args.get('resize', None)
+
+    if settings['format'] == 'jpeg':
+        settings['quality'] = _args.get('quality', 85)
+        settings['thumbnail'] = _args.get('thumbnail', None)
+
+    return settings
+
+
+def _capture_options(_args):
+    format = _args.get('format', 'jpeg')
+
+    options = dict([('format', format),
+                    ('resize', _args.get('resize', None))])
+    if format == 'jpeg':
+        options['quality'] = _args.get('quality', 85)
+        options['thumbnail'] = _args.get('thumbnail', None)
+
+    return options
+
+
+def capture_image(_camera, _args, _video_port=False, _stream=None):
+    """
+    Capture a single frame from an already configured camera.
+
+    :param _camera: An open camera
+    :param _args:
+    :param _video_port: Capture from the video port, faster but lower quality
+    :param _stream: An empty stream to capture into, a new one by default
+    :return: A stream holding the captured image
+    :raise TwistedPiValueError:
+    """
+    stream = _stream if _stream is not None else io.BytesIO()
+
+    try:
+        _camera.capture(stream, use_video_port=_video_port,
+                        **_capture_options(_args))
+
+    except ValueError:
+        raise TwistedPiValueError('Bad Camera Argument',
+                                  ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+    return stream
+
+
+def capture_sample(_camera, _resolution, _splitterPort):
+    """
+    Capture a small unencoded YUV frame from a splitter port of the video
+    port. The capture does not touch the camera settings.
+
+    :param _camera: An open camera
+    :param _resolution: Size of the frame
+    :param _splitterPort: The splitter port to capture from
+    :return: A stream holding the frame
+    """
+    stream = io.BytesIO()
+
+    _camera.capture(stream, format='yuv', use_video_port=True,
+                    resize=tuple(_resolution), splitter_port=_splitterPort)
+
+    return stream
+
+
+def capture_burst(_camera, _args, _count, _interval, _frameReady):
     """
-    Capture an image using the provided arguments.
+    Capture a sequence of frames from the video port of an already
+    configured camera. The camera keeps running between frames so the
+    frame rate is only limited by the encoder.
 
+    :param _camera: An open camera
     :param _args:
-    :return:
-    :raise TwistedPiException:
+    :param _count: Number of frames to capture
+    :param _interval: Minimum time between frames, in seconds
+    :param _frameReady: Called with the image data, the frame sequence
+                        number and the capture time for every frame
+    :raise TwistedPiValueError:
+    """
+    stream = io.BytesIO()
+
+    try:
+        frames = _camera.capture_continuous(stream, use_video_port=True,
+                                            **_capture_options(_args))
+        try:
+            started = time.time()
+            for sequence, _ in enumerate(frames, 1):
+                _frameReady(stream.getvalue(), sequence, time.time())
+                if sequence >= _count:
+                    break
+
+                stream.seek(0)
+                stream.truncate()
+
+                delay = started + sequence * _interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            frames.close()
+
+    except ValueError:
+        raise TwistedPiValueError('Bad Camera Argument',
+                                  ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+
+class CameraSession(object):
+    """
+    A long lived camera session.
+
+    Opening the camera is slow, the sensor has to warm up and the gain and
+    white balance need time to settle. The session keeps the camera open
+    between captures and serializes all access to it. If the camera fails
+    it is closed and reopened on the next capture.
+
+    :param _backend: The CameraBackend providing the camera
+    :param _metrics: Registry for the camera timings
     """
-    with __lock:
-        with picamera.PiCamera() as camera:
-            stream = io.BytesIO()
 
-            #Configure Camera
+    def __init__(self, _backend, _metrics=None):
+        self.backend = _backend
+        self.metrics = _metrics if _metrics is not None else MetricsRegistry()
+
+        self._lock = threading.Lock()
+        self._camera = None
+        self._settings = dict()
+        self._defaults = None
+        self._recording = None
+
+    @property
+    def is_open(self):
+        """
+        True if the camera is currently open.
+        """
+        return self._camera is not None
+
+    @property
+    def resolution(self):
+        """
+        The resolution the camera is currently configured with, or None if
+        the camera is closed.
+        """
+        return self._settings.get('resolution', None)
+
+    def open(self):
+        """
+        Open the camera unless it is already open.
+        """
+        with self._lock:
+            self._open()
+
+    def close(self):
+        """
+        Close the camera if it is open.
+        """
+        with self._lock:
+            self._close()
+
+    def _open(self):
+        if self._camera is None:
+            _log.debug('Opening camera')
+            with self.metrics.time('camera_open'):
+                self._camera = self.backend.open()
+            self._settings = read_settings(self._camera)
+
+            #Every capture starts from the settings of a fresh camera
+            self._defaults = dict(self._settings)
+            self._defaults['exif_tags'] = dict(self._camera.exif_tags)
+
+        return self._camera
+
+    def _close(self):
+        if self._camera is not None:
+            _log.debug('Closing camera')
             try:
-                if 'resolution' in _args:
-                    camera.resolution = (_args['resolution'][0],
-                                         _args['resolution'][1])
-                if 'ISO' in _args:
-                    camera.ISO = _args['ISO']
-                if 'awb_mode' in _args:
-                    camera.awb_mode = _args['awb_mode']
-                if 'brightness' in _args:
-                    camera.brightness = _args['brightness']
-                if 'color_effects' in _args:
-                    camera.color_effects = _args['color_effects']
-                if 'contrast' in _args:
-                    camera.contrast = _args['contrast']
-                if 'crop' in _args:
-                    camera.crop = _args['crop']
-                if 'exif_tags' in _args:
-                    for k, v in _args['exif_tags']:
-                        camera.exif_tags[k] = v
-                if 'exposure_compensation' in _args:
-                    camera.exposure_compensation = _args['exposure_compensation']
-                if 'exposure_mode' in _args:
-                    camera.exposure_mode = _args['exposure_mode']
-                if 'hflip' in _args:
-                    camera.hflip = _args['hflip']
-                if 'led' in _args:
-                    camera.led = _args['led']
-                if 'meter_mode' in _args:
-                    camera.meter_mode = _args['meter_mode']
-                if 'rotation' in _args:
-                    camera.rotation = _args['rotation']
-                if 'saturation' in _args:
-                    camera.rotation = _args['saturation']
-                if 'sharpness' in _args:
-                    camera.sharpness = _args['sharpness']
-                if 'shutter_speed' in _args:
-                    camera.shutter_speed = _args['shutter_speed']
-                if 'vflip' in _args:
-                    camera.vflip = _args['vflip']
-
-            except picamera.PiCameraValueError as e:
-                raise TwistedPiValueError('Invalid Camera Arguments',
-                                          ErrorCodes.INVALID_CAMERA_ARGUMENT)
-
-            #Capture frame
+                self._camera.close()
+            except Exception as _e:
+                log.err(_e)
+            finally:
+                self._camera = None
+                self._settings = dict()
+                self._defaults = None
+                self._recording = None
+
+    def _configure(self, _camera, _args, _plan=None):
+        if _plan is None:
+            _plan = compile_settings(_args)
+
+        if self._recording is not None:
+            #The running encoder is bound to its resolution
+            resolution = dict(_plan).get('resolution',
+                                         self._defaults['resolution'])
+            if resolution != self._settings['resolution']:
+                raise TwistedPiValueError(
+                    'Resolution can not change while recording',
+                    ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        return configure_camera(_camera, _args, self._settings, _plan,
+                                self._defaults)
+
+    @property
+    def is_recording(self):
+        """
+        True if the camera is recording into a circular buffer.
+        """
+        return self._recording is not None
+
+    def start_recording(self, _seconds, _bitrate, _splitterPort):
+        """
+        Start recording H.264 video into an in-memory circular buffer
+        holding the most recent seconds of video. The recording runs in the
+        background until it is stopped or the camera is closed.
+
+        :param _seconds: Length of the buffer, in seconds
+        :param _bitrate: Bitrate of the video
+        :param _splitterPort: The splitter port to record from
+        :raise TwistedPiException:
+        """
+        with self._lock:
+            try:
+                camera = self._open()
+                if self._recording is not None:
+                    return
+
+                stream = self.backend.circular_buffer(camera, _seconds,
+                                                      _bitrate, _splitterPort)
+                camera.start_recording(stream, format='h264',
+                                       bitrate=_bitrate,
+                                       splitter_port=_splitterPort)
+                self._recording = (stream, _splitterPort)
+            except TwistedPiException:
+                raise
+            except Exception as _e:
+                self._failed(_e)
+
+    def stop_recording(self):
+        """
+        Stop a running recording.
+        """
+        with self._lock:
+            if self._recording is None:
+                return
+
+            _, splitter_port = self._recording
+            self._recording = None
+            try:
+                self._camera.stop_recording(splitter_port=splitter_port)
+            except Exception as _e:
+                self._failed(_e)
+
+    def copy_recording(self, _seconds):
+        """
+        Copy the most recent video from the circular buffer, starting at a
+        key frame. Does not wait for the camera, the buffer is safe to read
+        while the recording runs.
+
+        :param _seconds: Length of the video to copy, in seconds
+        :return: The H.264 video
+        :raise TwistedPiException:
+        """
+        recording = self._recording
+        if recording is None:
+            raise TwistedPiException('Not recording', ErrorCodes.BAD_REQUEST)
+
+        stream, _ = recording
+        output = io.BytesIO()
+        with self.metrics.time('recording_copy'):
+            self.backend.copy_buffer(stream, _seconds, output)
+
+        return output.getvalue()
+
+    def take_image(self, _args, _video_port=False, _plan=None):
+        """
+        Capture an image using the provided arguments.
+
+        :param _args:
+        :param _video_port: Capture from the video port
+        :param _plan: Precompiled camera settings for the arguments
+        :return: A tuple with the captured image and the settings in effect
+                 for the capture
+        :raise TwistedPiException:
+        """
+        with self._lock:
+            try:
+                camera = self._open()
+                with self.metrics.time('camera_configure'):
+                    self._configure(camera, _args, _plan)
+
+                with self.metrics.time('camera_capture'):
+                    stream = capture_image(camera, _args, _video_port)
+                #The image is copied out of the stream once, here. Frames are
+                #shared through the cache and the coalescer and may sit in the
+                #transport until the socket drains, so they must be immutable.
+                image = stream.getvalue()
+
+                return image, capture_settings(self._settings, _args)
+            except TwistedPiException:
+                raise
+            except Exception as _e:
+                self._failed(_e)
+
+    def take_sample(self, _resolution, _splitterPort):
+        """
+        Capture a small YUV frame for analysis with whatever settings are
+        currently applied.
+
+        :param _resolution: Size of the frame
+        :param _splitterPort: The splitter port to capture from
+        :return: The frame data
+        :raise TwistedPiException:
+        """
+        with self._lock:
+            try:
+                camera = self._open()
+
+                with self.metrics.time('camera_sample'):
+                    stream = capture_sample(camera, _resolution,
+                                            _splitterPort)
+                return stream.getvalue()
+            except TwistedPiException:
+                raise
+            except Exception as _e:
+                self._failed(_e)
+
+    def take_burst(self, _args, _count, _interval, _frameReady):
+        """
+        Capture a burst of frames using the provided arguments. Called from
+        a worker thread, `_frameReady` is called in the same thread.
+
+        :param _args:
+        :param _count: Number of frames to capture
+        :param _interval: Minimum time between frames, in seconds
+        :param _frameReady: Called with the image data, the frame sequence
+                            number and the capture time for every frame
+        :return: The settings in effect for the burst
+        :raise TwistedPiException:
+        """
+        with self._lock:
             try:
-                format = _args.get('format', 'jpeg')
-                resize = _args.get('resize', None)
-
-                options = dict()
-                if format == 'jpeg':
-                    options['quality'] = _args.get('quality', 85)
-                    options['thumbnail'] = _args.get('thumbnail', None)
-
-                camera.capture(stream, format=format, use_video_port=False,
-                               resize=resize, **options)
-
-            except picamera.PiCameraValueError as e:
-                raise TwistedPiValueError('Bad Camera Argument',
-                                          ErrorCodes.INVALID_CAMERA_ARGUMENT)
-            else:
-                #Save all camera settings
-                settings = dict([
-                    ('resolution', camera.resolution),
-                    ('ISO', camera.ISO),
-                    ('awb_mode', camera.awb_mode),
-                    ('brightness', camera.brightness),
-                    ('color_effects', camera.color_effects),
-                    ('contrast', camera.contrast),
-                    ('crop', camera.crop),
-                    ('exif_tags', camera.exif_tags),
-                    ('exposure_compensation', camera.exposure_compensation),
-                    ('exposure_mode', camera.exposure_mode),
-                    ('hflip', camera.hflip),
-                    ('led', camera.led),
-                    ('meter_mode', camera.meter_mode),
-                    ('rotation', camera.rotation),
-                    ('saturation', camera.saturation),
-                    ('sharpness', camera.sharpness),
-                    ('shutter_speed', camera.shutter_speed),
-                    ('vflip', camera.vflip)])
-
-                settings['format'] = format
-                settings['resize'] = resize
-
-                if format == 'jpeg':
-                    settings['quality'] = options['quality']
-                    settings['thumbnail'] = options['thumbnail']
-
-                return stream
+                camera = self._open()
+                with self.metrics.time('camera_configure'):
+                    self._configure(camera, _args)
+
+                with self.metrics.time('camera_burst'):
+                    capture_burst(camera, _args, _count, _interval,
+                                  _frameReady)
+
+                return capture_settings(self._settings, _args)
+            except TwistedPiException:
+                raise
+            except Exception as _e:
+                self._failed(_e)
+
+    def preconfigure(self, _resolution):
+        """
+        Switch the camera to a resolution ahead of the captures expected to
+        use it, so that those captures skip the slow pipeline change. No
+        other setting is touched, every capture still applies its own
+        settings on top of the defaults.
+
+        :param _resolution: The resolution to switch to
+        :raise TwistedPiException:
+        """
+        with self._lock:
+            try:
+                camera = self._open()
+                if self._recording is not None:
+                    return
+
+                resolution = _setting_value(_resolution)
+                if self._settings['resolution'] != resolution:
+                    with self.metrics.time('camera_configure'):
+                        camera.resolution = resolution
+                    self._settings['resolution'] = resolution
+            except TwistedPiException:
+                raise
+            except Exception as _e:
+                self._failed(_e)
+
+    def _failed(self, _e):
+        #Drop the camera, it will be reopened on the next capture
+        log.err(_e)
+        self._close()
+        raise TwistedPiException('Camera failure', ErrorCodes.SERVER_ERROR)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Capture module
+"""
+
+#Twisted modules
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+import json
+
+#twistedpi modules
+from Log import Logger
+
+
+_log = Logger(__name__)
+
+
+def normalize_args(_args):
+    """
+    Create a key identifying the capture described by the arguments. Two
+    argument dictionaries with equal content produce the same key.
+
+    :param _args: Validated image arguments
+    :return: A hashable key
+    """
+    return json.dumps(_args, sort_keys=True)
+
+
+class CaptureCoalescer(object):
+    """
+    Share a single capture between concurrent requests with equal arguments.
+
+    A request arriving while a capture with the same arguments is pending or
+    running is attached to that capture and receives the same result,
+    instead of queueing for a capture of its own.
+
+    :param _capture: Callable taking image arguments and returning a Deferred
+    :param _join: Optional callable taking the Deferred of a pending
+                  capture, the Deferred returned to a request waiting for it
+                  and the options of the request. Called for every request
+                  waiting for a capture, lets the capture adopt the priority
+                  of a joining request and enforce the deadline of every
+                  request on its own.
+    """
+
+    def __init__(self, _capture, _join=None):
+        self._capture = _capture
+        self._join = _join
+        self._pending = dict()
+
+        self.captures = 0
+        self.coalesced = 0
+
+    def capture(self, _args, *_options):
+        """
+
+        :param _args: Validated image arguments
+        :param _options: Passed on to the capture callable when a new
+                         capture is started
+        :return: A Deferred firing with the capture result
+        """
+        key = normalize_args(_args)
+        waiter = Deferred()
+
+        if key in self._pending:
+            _log.debug('Coalescing capture request')
+            self.coalesced += 1
+
+            d, waiters = self._pending[key]
+            waiters.append(waiter)
+            if self._join is not None:
+                self._join(d, waiter, *_options)
+        else:
+            waiters = [waiter]
+            self.captures += 1
+
+            d = self._capture(_args, *_options)
+            if not d.called:
+                self._pending[key] = (d, waiters)
+                if self._join is not None:
+                    self._join(d, waiter, *_options)
+            d.addBoth(self._captureDone, key, waiters)
+
+        return waiter
+
+    def stats(self):
+        """
+
+        :return: A dictionary with coalescing statistics
+        """
+        return dict([('captures', self.captures),
+                     ('coalesced', self.coalesced),
+                     ('pending', len(self._pending))])
+
+    def _captureDone(self, _result, _key, _waiters):
+        self._pending.pop(_key, None)
+
+        for waiter in _waiters:
+            if waiter.called:
+                #Failed at its own deadline
+                continue
+
+            if isinstance(_result, Failure):
+                waiter.errback(_result)
+            else:
+                waiter.callback(_result)
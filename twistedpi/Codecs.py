@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Codec module
+"""
+
+import json
+
+#Optional codecs
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiValueError
+
+
+class Binary(object):
+    """
+    Raw data that the binary codecs pack as binary. Every other string is
+    packed as text, under Python 2 a plain ``str`` would otherwise be packed
+    as binary as well, keys and command names included.
+
+    :param _data: The raw bytes
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, _data):
+        self.data = _data
+
+
+def _packable(_value):
+    #Turn Binary values into raw bytes and, under Python 2 where str is
+    #bytes, every other str into text
+    if isinstance(_value, Binary):
+        return _value.data
+
+    if isinstance(_value, dict):
+        return dict([(_packable(k), _packable(v))
+                     for k, v in _value.items()])
+
+    if isinstance(_value, (list, tuple)):
+        return [_packable(v) for v in _value]
+
+    if bytes is str and isinstance(_value, bytes):
+        try:
+            return _value.decode('utf-8')
+        except UnicodeDecodeError:
+            return _value
+
+    return _value
+
+
+class JSONCodec(object):
+    """
+    The default codec. Binary data has to be base64 encoded or sent in a
+    netstring of its own.
+    """
+    name = 'json'
+    binary = False
+
+    def encode(self, _value):
+        return json.dumps(_value)
+
+    def decode(self, _data):
+        return json.loads(_data)
+
+
+class MsgpackCodec(object):
+    """
+    MessagePack, carries binary data wrapped in Binary natively.
+    """
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, _value):
+        return msgpack.packb(_packable(_value), use_bin_type=True)
+
+    def decode(self, _data):
+        try:
+            return msgpack.unpackb(_data, raw=False)
+        except Exception as _e:
+            raise ValueError(str(_e))
+
+
+class CBORCodec(object):
+    """
+    CBOR, carries binary data wrapped in Binary natively.
+    """
+    name = 'cbor'
+    binary = True
+
+    def encode(self, _value):
+        return cbor2.dumps(_packable(_value))
+
+    def decode(self, _data):
+        try:
+            return cbor2.loads(_data)
+        except Exception as _e:
+            raise ValueError(str(_e))
+
+
+JSON = JSONCodec()
+
+CODECS = dict([(JSON.name, JSON)])
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+if cbor2 is not None:
+    CODECS[CBORCodec.name] = CBORCodec()
+
+
+def get_codec(_name):
+    """
+
+    :param _name: A codec name
+    :return: The codec
+    :raise TwistedPiValueError: If the codec is unknown or not installed
+    """
+    try:
+        return CODECS[_name]
+    except (KeyError, TypeError):
+        raise TwistedPiValueError('Unknown codec', ErrorCodes.BAD_REQUEST)
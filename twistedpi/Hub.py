@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hub module
+"""
+
+#Zope modules
+from zope.interface import implementer
+
+#Twisted modules
+from twisted.application import service
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet import task
+
+from collections import deque
+import time
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException, TwistedPiValueError
+from Log import Logger
+
+
+_log = Logger(__name__)
+
+#Default number of messages queued for a subscriber that can not keep up
+DEFAULT_QUEUE_SIZE = 8
+
+#Default frame rate of the shared frame feed
+DEFAULT_FEED_FPS = 5
+
+#Channel of the shared frame feed
+FRAMES = 'frames'
+
+
+@implementer(IPushProducer)
+class Subscriber(object):
+    """
+    The subscriptions of a single connection.
+
+    The subscriber is registered as a streaming producer on the transport.
+    A message is only handed to the protocol once the previous one has been
+    sent. While a message is being sent or the transport is paused, further
+    messages wait in a bounded queue and the oldest message is dropped when
+    it is full, so a slow client only ever misses messages and never makes
+    the server buffer them.
+
+    :param _protocol: The protocol receiving the messages
+    :param _maxQueue: Largest number of waiting messages
+    """
+
+    def __init__(self, _protocol, _maxQueue=DEFAULT_QUEUE_SIZE):
+        self.protocol = _protocol
+        self.channels = dict()
+        self.queue = deque(maxlen=_maxQueue)
+
+        self.paused = False
+        self.sending = False
+        self._flushing = False
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(self, _channel, _message):
+        """
+        Queue a message and send it unless the transport is paused.
+
+        :param _channel: The channel of the message
+        :param _message: A response, without an id
+        """
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((_channel, _message))
+
+        self._flush()
+
+    def _flush(self):
+        #A message sent right away calls back into _flush, the loop below
+        #carries on with the next message instead
+        if self._flushing:
+            return
+
+        self._flushing = True
+        try:
+            #Writing may pause the transport, check before every message
+            while self.queue and not self.paused and not self.sending:
+                channel, message = self.queue.popleft()
+                if not channel in self.channels:
+                    continue
+
+                self.sent += 1
+                self.sending = True
+                d = self.protocol.sendMessage(message,
+                                              self.channels[channel])
+                d.addBoth(self._messageSent)
+        finally:
+            self._flushing = False
+
+    def _messageSent(self, _result):
+        self.sending = False
+        self._flush()
+        return _result
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its buffer is full.
+        """
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+        Called by the transport when its buffer has been drained.
+        """
+        self.paused = False
+        self._flush()
+
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost.
+        """
+        self.paused = True
+        self.queue.clear()
+
+
+class Hub(object):
+    """
+    Publish frames and events to every connection subscribed to a channel.
+
+    A message is built once and shared by all subscribers, binary payloads
+    are encoded at most once whatever the number of subscribers.
+
+    :param _maxQueue: Largest number of messages waiting per subscriber
+    """
+
+    def __init__(self, _maxQueue=DEFAULT_QUEUE_SIZE):
+        self.max_queue = _maxQueue
+
+        self._channels = dict()
+        self._subscribers = dict()
+
+        self.published = 0
+
+    def addChannel(self, _channel):
+        """
+        Make a channel available to subscribers.
+
+        :param _channel: Name of the channel
+        """
+        self._channels.setdefault(_channel, set())
+
+    def subscribers(self, _channel):
+        """
+
+        :param _channel: Name of the channel
+        :return: Number of subscribers of the channel
+        """
+        return len(self._channels.get(_channel, ()))
+
+    def isSubscribed(self, _protocol):
+        """
+
+        :param _protocol: A protocol
+        :return: True if the protocol is subscribed to any channel
+        """
+        return _protocol in self._subscribers
+
+    def subscribe(self, _protocol, _channel, _id=None):
+        """
+        Subscribe a connection to a channel.
+
+        :param _protocol: The protocol receiving the messages
+        :param _channel: Name of the channel
+        :param _id: Id of the subscribing request, echoed in the messages
+        :raise TwistedPiValueError:
+        """
+        if not _channel in self._channels:
+            raise TwistedPiValueError('Unknown channel',
+                                      ErrorCodes.BAD_REQUEST)
+
+        subscriber = self._subscribers.get(_protocol, None)
+        if subscriber is None:
+            subscriber = Subscriber(_protocol, self.max_queue)
+            self._subscribers[_protocol] = subscriber
+            _protocol.transport.registerProducer(subscriber, True)
+
+        subscriber.channels[_channel] = _id
+        self._channels[_channel].add(subscriber)
+
+    def unsubscribe(self, _protocol, _channel=None):
+        """
+        Unsubscribe a connection from a channel.
+
+        :param _protocol: The protocol receiving the messages
+        :param _channel: Name of the channel, or None for every channel
+        :return: True if the connection was subscribed
+        """
+        subscriber = self._subscribers.get(_protocol, None)
+        if subscriber is None:
+            return False
+
+        channels = list(subscriber.channels) if _channel is None \
+            else [_channel]
+
+        found = False
+        for channel in channels:
+            if channel in subscriber.channels:
+                del subscriber.channels[channel]
+                self._channels[channel].discard(subscriber)
+                found = True
+
+        if not subscriber.channels:
+            del self._subscribers[_protocol]
+            subscriber.stopProducing()
+            _protocol.transport.unregisterProducer()
+
+        return found
+
+    def publish(self, _channel, _message):
+        """
+        Send a message to every subscriber of a channel.
+
+        :param _channel: Name of the channel
+        :param _message: A response, without an id
+        """
+        self.published += 1
+
+        for subscriber in list(self._channels.get(_channel, ())):
+            subscriber.publish(_channel, _message)
+
+    def stats(self):
+        """
+
+        :return: A dictionary with hub statistics
+        """
+        subscribers = self._subscribers.values()
+        return dict([('channels', dict([(channel, len(members))
+                                        for channel, members
+                                        in self._channels.items()])),
+                     ('published', self.published),
+                     ('sent', sum([s.sent for s in subscribers])),
+                     ('dropped', sum([s.dropped for s in subscribers]))])
+
+
+class FrameFeed(service.Service):
+    """
+    Capture frames from the video port while the frame channel has
+    subscribers and publish every frame once to all of them, whatever the
+    number of viewers.
+
+    :param _hub: The Hub publishing the frames
+    :param _capture: Callable taking a deadline and returning a Deferred
+                     firing with the payload of a captured frame
+    :param _fps: Frames per second
+    """
+
+    def __init__(self, _hub, _capture, _fps=DEFAULT_FEED_FPS):
+        self.hub = _hub
+        self.capture = _capture
+        self.fps = _fps
+
+        self.frames = 0
+        self.skipped = 0
+
+        self._loop = task.LoopingCall(self._captureFrame)
+
+        self.hub.addChannel(FRAMES)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop.start(1.0 / self.fps, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+
+    def _captureFrame(self):
+        if not self.hub.subscribers(FRAMES):
+            return None
+
+        d = self.capture(1.0 / self.fps)
+        d.addCallbacks(self._frameCaptured, self._frameFailed)
+        return d
+
+    def _frameCaptured(self, _payload):
+        self.frames += 1
+        self.hub.publish(FRAMES, dict([('command', 'FRAME'),
+                                       ('frame', self.frames),
+                                       ('timestamp', time.time()),
+                                       ('payload', _payload)]))
+
+    def _frameFailed(self, _failure):
+        #Errors would stop the loop, skip the frame instead
+        self.skipped += 1
+        if _failure.check(TwistedPiException):
+            _log.debug('Feed frame skipped: {0}', _failure.value.msg)
+        else:
+            _log.error('Frame feed capture failed: {0}', _failure.value)
+
+    def stats(self):
+        """
+
+        :return: A dictionary with frame feed statistics
+        """
+        return dict([('fps', self.fps), ('frames', self.frames),
+                     ('skipped', self.skipped)])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logging module
+"""
+
+from twisted.python import log
+
+import logging
+import random
+
+
+LEVELS = dict([('debug', logging.DEBUG), ('info', logging.INFO),
+               ('warning', logging.WARNING), ('error', logging.ERROR)])
+
+#Messages below this level are dropped before they are formatted
+_threshold = logging.INFO
+
+
+def set_level(_name):
+    """
+    Set the level below which messages are dropped.
+
+    :param _name: One of the names in LEVELS
+    :raise ValueError:
+    """
+    global _threshold
+
+    try:
+        _threshold = LEVELS[_name]
+    except KeyError:
+        raise ValueError('Unknown log level {0}'.format(_name))
+
+
+class Logger(object):
+    """
+    A level gated logger writing to the Twisted log.
+
+    Messages are ``str.format`` templates. The arguments are only formatted
+    into the template when the message passes the level check, so debug
+    messages cost next to nothing when debug logging is off.
+
+    :param _system: Name of the logging component
+    """
+
+    def __init__(self, _system):
+        self.system = _system
+
+    def isEnabledFor(self, _level):
+        """
+
+        :param _level:
+        :return: True if messages at the level are emitted
+        """
+        return _level >= _threshold
+
+    def _emit(self, _level, _format, _args, _kwargs):
+        if _level < _threshold:
+            return
+
+        if _args or _kwargs:
+            _format = _format.format(*_args, **_kwargs)
+
+        log.msg(_format, logLevel=_level, system=self.system)
+
+    def debug(self, _format, *_args, **_kwargs):
+        self._emit(logging.DEBUG, _format, _args, _kwargs)
+
+    def info(self, _format, *_args, **_kwargs):
+        self._emit(logging.INFO, _format, _args, _kwargs)
+
+    def warning(self, _format, *_args, **_kwargs):
+        self._emit(logging.WARNING, _format, _args, _kwargs)
+
+    def error(self, _format, *_args, **_kwargs):
+        self._emit(logging.ERROR, _format, _args, _kwargs)
+
+
+class AccessLog(object):
+    """
+    A sampled access log, one line per logged request.
+
+    :param _sample: Fraction of the requests to log, 0 disables the log
+    """
+
+    def __init__(self, _sample=0.0):
+        self.sample = _sample
+        self._logger = Logger('access')
+
+    def record(self, _response, _duration):
+        """
+        Maybe log a handled request.
+
+        :param _response: The response to the request
+        :param _duration: Time spent handling the request, in seconds
+        """
+        if self.sample <= 0 or random.random() >= self.sample:
+            return
+
+        status = 'ok'
+        if 'error' in _response:
+            status = _response['error']['code']
+
+        self._logger.info('{0} id={1} status={2} time={3:.1f}ms',
+                          _response.get('command', None),
+                          _response.get('id', None), status, _duration * 1000)
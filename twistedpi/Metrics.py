@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Metrics module
+"""
+
+#Twisted modules
+from twisted.web.resource import Resource
+
+from contextlib import contextmanager
+import bisect
+import numbers
+import re
+import threading
+import time
+
+
+#Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+#Prefix of all exported metric names
+PREFIX = 'twistedpi_'
+
+#Characters not allowed in a Prometheus metric name
+_INVALID_NAME = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def _key(_name, _labels):
+    if not _labels:
+        return _name, ()
+
+    return _name, tuple(sorted(_labels.items()))
+
+
+def _prometheusName(_key, _suffix='', _extra=()):
+    name, labels = _key
+    labels = labels + _extra
+
+    text = _INVALID_NAME.sub('_', PREFIX + name + _suffix)
+    if labels:
+        text += '{' + ','.join(['{0}="{1}"'.format(k, _labelValue(v))
+                                for k, v in labels]) + '}'
+    return text
+
+
+def _labelValue(_value):
+    return str(_value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets.
+
+    :param _buckets: Sorted upper bounds of the buckets
+    """
+
+    def __init__(self, _buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(_buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, _value):
+        """
+
+        :param _value:
+        """
+        self.counts[bisect.bisect_left(self.buckets, _value)] += 1
+        self.sum += _value
+        self.count += 1
+
+    def snapshot(self):
+        """
+
+        :return: A dictionary with the cumulative bucket counts, sum and count
+        """
+        cumulative = list()
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return dict([('buckets', cumulative), ('sum', self.sum),
+                     ('count', self.count)])
+
+
+class MetricsRegistry(object):
+    """
+    Counters, latency histograms and gauges for the server. Updates may come
+    from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        self._gauges = dict()
+
+    def increment(self, _name, _value=1, _labels=None):
+        """
+        Increment a counter.
+
+        :param _name: Counter name
+        :param _value: Amount to add
+        :param _labels: Optional dictionary of labels
+        """
+        key = _key(_name, _labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + _value
+
+    def observe(self, _name, _value, _labels=None):
+        """
+        Record a value in a histogram.
+
+        :param _name: Histogram name
+        :param _value: Value in seconds
+        :param _labels: Optional dictionary of labels
+        """
+        key = _key(_name, _labels)
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(_value)
+
+    @contextmanager
+    def time(self, _name, _labels=None):
+        """
+        Time the enclosed block and record the duration in a histogram.
+
+        :param _name: Histogram name
+        :param _labels: Optional dictionary of labels
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(_name, time.time() - started, _labels)
+
+    def timed(self, _name, _function):
+        """
+        Wrap a callable so that every call is timed.
+
+        :param _name: Histogram name
+        :param _function:
+        :return: The wrapped callable
+        """
+        def wrapper(*args, **kwargs):
+            with self.time(_name):
+                return _function(*args, **kwargs)
+
+        return wrapper
+
+    def gauge(self, _name, _function, _label=None):
+        """
+        Register a gauge, a callable returning a number or a dictionary of
+        numbers that is read when the metrics are collected. A gauge with a
+        label returns a dictionary of such values by label value, such as
+        the statistics of every node by node name.
+
+        :param _name: Gauge name
+        :param _function:
+        :param _label: Name of the label, or None
+        """
+        self._gauges[_name] = (_function, _label)
+
+    def _collectGauges(self):
+        gauges = dict()
+        for name, (function, label) in self._gauges.items():
+            value = function()
+            if label is None:
+                _addGauge(gauges, name, value)
+            else:
+                for labelValue, v in value.items():
+                    _addGauge(gauges, name, v,
+                              dict([(label, labelValue)]))
+
+        return gauges
+
+    def snapshot(self):
+        """
+
+        :return: A JSON serializable dictionary of all metrics
+        """
+        def label(_key):
+            name, labels = _key
+            if labels:
+                name += '{' + ','.join(['{0}={1}'.format(k, v)
+                                        for k, v in labels]) + '}'
+            return name
+
+        with self._lock:
+            counters = dict([(label(k), v)
+                             for k, v in self._counters.items()])
+            histograms = dict([(label(k), h.snapshot())
+                               for k, h in self._histograms.items()])
+
+        gauges = dict([(label(k), v)
+                       for k, v in self._collectGauges().items()])
+
+        return dict([('counters', counters), ('histograms', histograms),
+                     ('gauges', gauges)])
+
+    def prometheus(self):
+        """
+
+        :return: All metrics in the Prometheus text exposition format
+        """
+        lines = list()
+
+        with self._lock:
+            for key in sorted(self._counters):
+                lines.append('{0} {1}'.format(_prometheusName(key, '_total'),
+                                              self._counters[key]))
+
+            for key in sorted(self._histograms):
+                snapshot = self._histograms[key].snapshot()
+                for bound, count in snapshot['buckets']:
+                    name = _prometheusName(key, '_seconds_bucket',
+                                           (('le', bound),))
+                    lines.append('{0} {1}'.format(name, count))
+
+                lines.append('{0} {1}'.format(
+                    _prometheusName(key, '_seconds_sum'), snapshot['sum']))
+                lines.append('{0} {1}'.format(
+                    _prometheusName(key, '_seconds_count'), snapshot['count']))
+
+        #Only numbers can be exported, flags are exported as 0 or 1
+        gauges = self._collectGauges()
+        for key in sorted(gauges):
+            value = gauges[key]
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, numbers.Number):
+                continue
+
+            lines.append('{0} {1}'.format(_prometheusName(key), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _addGauge(_gauges, _name, _value, _labels=None):
+    if isinstance(_value, dict):
+        for k, v in _flatten(_value):
+            _gauges[_key('{0}_{1}'.format(_name, k), _labels)] = v
+    else:
+        _gauges[_key(_name, _labels)] = _value
+
+
+def _flatten(_value, _prefix=''):
+    for k, v in sorted(_value.items()):
+        name = _prefix + str(k)
+        if isinstance(v, dict):
+            for item in _flatten(v, name + '_'):
+                yield item
+        else:
+            yield name, v
+
+
+class MetricsResource(Resource):
+    """
+    Serve the metrics in the Prometheus text format over HTTP.
+
+    :param _metrics: A MetricsRegistry
+    """
+    isLeaf = True
+
+    def __init__(self, _metrics):
+        Resource.__init__(self)
+        self.metrics = _metrics
+
+    def render_GET(self, _request):
+        _request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.metrics.prometheus()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Motion module
+"""
+
+#Twisted modules
+from twisted.application import service
+from twisted.internet import task
+
+import time
+
+#Optional array library, required for motion detection
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException, TwistedPiValueError
+from Log import Logger
+from Renditions import raw_resolution
+import Scheduler
+
+
+_log = Logger(__name__)
+
+#Size of the frames analysed for motion
+DEFAULT_RESOLUTION = (160, 120)
+
+#Side of the square blocks compared between frames, in pixels
+DEFAULT_BLOCK_SIZE = 8
+
+#Mean change of the brightness of a block, 0-255, counting as motion
+DEFAULT_THRESHOLD = 12
+
+#Fraction of the blocks that have to change to report motion
+DEFAULT_AREA = 0.01
+
+#Default time between analysed frames, in seconds
+DEFAULT_INTERVAL = 0.5
+
+#Splitter port sampled for motion, leaving port 0 to the video captures
+SPLITTER_PORT = 2
+
+#Hub channel of the motion events
+CHANNEL = 'motion'
+
+
+def parse_regions(_value):
+    """
+    Parse regions of interest given as ``x,y,w,h`` rectangles separated by
+    ``;``, in fractions of the frame.
+
+    :param _value: The regions, or None for the whole frame
+    :return: A list of (x, y, w, h) tuples, or None
+    :raise TwistedPiValueError:
+    """
+    if not _value:
+        return None
+
+    regions = list()
+    try:
+        for region in _value.split(';'):
+            x, y, w, h = [float(v) for v in region.split(',')]
+            if not (0 <= x < 1 and 0 <= y < 1 and w > 0 and h > 0):
+                raise ValueError(region)
+            regions.append((x, y, w, h))
+    except ValueError:
+        raise TwistedPiValueError('Invalid motion regions {0}'.format(_value),
+                                  ErrorCodes.BAD_DATA)
+
+    return regions
+
+
+class MotionDetector(object):
+    """
+    Detect motion by comparing the brightness of consecutive frames.
+
+    The luma plane of every frame is split into square blocks and the mean
+    absolute difference of every block to the previous frame is computed in
+    one pass over the whole array. Motion is reported when enough blocks
+    within the regions of interest change more than the threshold.
+
+    :param _resolution: Size of the analysed frames
+    :param _threshold: Mean brightness change of a block counting as motion
+    :param _area: Fraction of the blocks that have to change
+    :param _regions: Regions of interest as returned by parse_regions, or
+                     None for the whole frame
+    :param _blockSize: Side of the blocks in pixels
+    :raise TwistedPiException:
+    """
+
+    def __init__(self, _resolution=DEFAULT_RESOLUTION,
+                 _threshold=DEFAULT_THRESHOLD, _area=DEFAULT_AREA,
+                 _regions=None, _blockSize=DEFAULT_BLOCK_SIZE):
+        if numpy is None:
+            raise TwistedPiException('numpy is not installed',
+                                     ErrorCodes.SERVER_ERROR)
+
+        self.resolution = tuple(_resolution)
+        self.threshold = _threshold
+        self.area = _area
+        self.block_size = _blockSize
+
+        width, height = self.resolution
+        self._blocks = (height // _blockSize, width // _blockSize)
+        self._mask = self._regionMask(_regions)
+        self._previous = None
+
+    def _regionMask(self, _regions):
+        rows, columns = self._blocks
+        if _regions is None:
+            return numpy.ones((rows, columns), dtype=bool)
+
+        mask = numpy.zeros((rows, columns), dtype=bool)
+        for x, y, w, h in _regions:
+            mask[int(y * rows):int(numpy.ceil(min(y + h, 1.0) * rows)),
+                 int(x * columns):int(numpy.ceil(min(x + w, 1.0) * columns))] = True
+
+        return mask
+
+    def reset(self):
+        """
+        Forget the previous frame, the next frame starts a new comparison.
+        """
+        self._previous = None
+
+    def _luma(self, _data):
+        #The Y plane comes first, padded like every raw frame
+        width, height = self.resolution
+        padded_width, padded_height = raw_resolution(self.resolution)
+
+        plane = numpy.frombuffer(_data, dtype=numpy.uint8,
+                                 count=padded_width * padded_height)
+        return plane.reshape((padded_height, padded_width))[:height, :width]
+
+    def detect(self, _data, _timestamp=None):
+        """
+        Compare a frame to the previous one. CPU bound, should run in a
+        worker thread, one frame at a time.
+
+        :param _data: A YUV frame at the resolution of the detector
+        :param _timestamp: Capture time of the frame
+        :return: A motion event, or None if nothing moved
+        """
+        rows, columns = self._blocks
+        size = self.block_size
+
+        luma = self._luma(_data)[:rows * size, :columns * size]
+        frame = luma.reshape((rows, size, columns, size)).astype(numpy.int16)
+
+        previous, self._previous = self._previous, frame
+        if previous is None:
+            return None
+
+        change = numpy.abs(frame - previous).mean(axis=(1, 3))
+        moved = (change > self.threshold) & self._mask
+
+        count = int(moved.sum())
+        fraction = float(count) / max(int(self._mask.sum()), 1)
+        if count == 0 or fraction < self.area:
+            return None
+
+        ys, xs = numpy.nonzero(moved)
+        box = [float(xs.min()) / columns, float(ys.min()) / rows,
+               float(xs.max() + 1 - xs.min()) / columns,
+               float(ys.max() + 1 - ys.min()) / rows]
+
+        return dict([('timestamp', _timestamp), ('blocks', count),
+                     ('fraction', fraction), ('box', box),
+                     ('level', float(change[moved].mean()))])
+
+
+class MotionService(service.Service):
+    """
+    Sample low resolution frames and publish motion events on the hub.
+
+    Frames are only sampled while the motion channel has subscribers. The
+    samples are scheduled with background priority and analysed in the
+    encode pool, a sample that can not run is skipped.
+
+    :param _factory: The ImageServerFactory owning the camera
+    :param _detector: The MotionDetector analysing the frames
+    :param _interval: Time between samples, in seconds
+    """
+
+    def __init__(self, _factory, _detector, _interval=DEFAULT_INTERVAL):
+        self.factory = _factory
+        self.detector = _detector
+        self.interval = _interval
+
+        self.samples = 0
+        self.skipped = 0
+        self.events = 0
+
+        self._loop = task.LoopingCall(self.sample)
+
+        self.factory.hub.addChannel(CHANNEL)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+
+    def sample(self):
+        """
+        Sample a frame and report any motion.
+
+        :return: A Deferred firing when the frame is analysed, or None
+        """
+        if not self.factory.hub.subscribers(CHANNEL):
+            #Forget the last frame so a new subscriber starts fresh
+            self.detector.reset()
+            return None
+
+        def sampled(_data):
+            self.samples += 1
+            return self.factory.encode(self.detector.detect, _data,
+                                       time.time())
+
+        def sampleError(_err):
+            #Errors would stop the loop, skip the sample instead
+            self.skipped += 1
+            if _err.check(TwistedPiException):
+                _log.debug('Motion sample skipped: {0}', _err.value.msg)
+            else:
+                _log.error('Motion sample failed: {0}', _err.value)
+
+        d = self.factory.scheduler.schedule(Scheduler.PRIORITY_BACKGROUND,
+                                            self.interval,
+                                            self.factory.camera.take_sample,
+                                            self.detector.resolution,
+                                            SPLITTER_PORT)
+        d.addCallback(sampled)
+        d.addCallbacks(self.publish, sampleError)
+
+        return d
+
+    def publish(self, _event):
+        """
+        Publish a motion event to the subscribers of the motion channel.
+
+        :param _event: The event, or None
+        """
+        if _event is None:
+            return
+
+        self.events += 1
+        _log.debug('Motion in {0} blocks', _event['blocks'])
+
+        self.factory.hub.publish(CHANNEL, dict([('command', 'MOTION'),
+                                                ('payload', _event)]))
+
+    def stats(self):
+        """
+
+        :return: A dictionary with motion detection statistics
+        """
+        return dict([('samples', self.samples), ('skipped', self.skipped),
+                     ('events', self.events)])
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Profiles module
+"""
+
+import json
+import types
+
+#twistedpi modules
+from Camera import CAMERA_SETTINGS, compile_settings, validate_image_args
+from errors import ErrorCodes, TwistedPiValueError
+from Log import Logger
+from Schema import IMAGE_SCHEMA
+
+
+_log = Logger(__name__)
+
+
+def validate_profile(_name, _args):
+    """
+    Validate a profile definition. Unlike a request, a profile may only
+    hold arguments described by the image schema.
+
+    :param _name: Name of the profile
+    :param _args: Image arguments of the profile
+    :return: A dictionary of validated arguments
+    :raise TwistedPiValueError:
+    """
+    if not isinstance(_name, types.StringTypes) or not _name:
+        raise TwistedPiValueError('Invalid profile name',
+                                  ErrorCodes.BAD_REQUEST)
+
+    if not isinstance(_args, dict):
+        raise TwistedPiValueError('Invalid profile settings',
+                                  ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+    for key in _args:
+        if not key in IMAGE_SCHEMA:
+            raise TwistedPiValueError('Unknown profile setting',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+    return validate_image_args(dict(_args))
+
+
+class Profile(object):
+    """
+    A named set of image arguments, validated once and compiled into an
+    apply plan for the camera.
+
+    :param _name: Name of the profile
+    :param _args: Validated image arguments
+    """
+
+    def __init__(self, _name, _args):
+        self.name = _name
+        self.args = _args
+        self.plan = compile_settings(_args)
+        self.uses = 0
+
+    def resolve(self, _args):
+        """
+        Combine the profile with the arguments of a request, arguments given
+        in the request take precedence over the profile.
+
+        :param _args: Request arguments
+        :return: A tuple with the combined arguments and their apply plan
+        """
+        args = dict(self.args)
+        args.update(_args)
+
+        for name in CAMERA_SETTINGS:
+            if name in _args:
+                return args, compile_settings(args)
+
+        return args, self.plan
+
+    def describe(self):
+        """
+
+        :return: A dictionary describing the profile
+        """
+        return dict([('settings', self.args), ('uses', self.uses)])
+
+
+class ProfileRegistry(object):
+    """
+    The capture profiles known to the server, by name.
+    """
+
+    def __init__(self):
+        self._profiles = dict()
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def __contains__(self, _name):
+        return _name in self._profiles
+
+    def define(self, _name, _args):
+        """
+        Add a profile, replacing any profile with the same name.
+
+        :param _name: Name of the profile
+        :param _args: Image arguments of the profile
+        :return: The new Profile
+        :raise TwistedPiValueError:
+        """
+        profile = Profile(_name, validate_profile(_name, _args))
+        self._profiles[_name] = profile
+
+        _log.debug('Defined profile {0}', _name)
+
+        return profile
+
+    def get(self, _name):
+        """
+
+        :param _name: Name of the profile
+        :return: The Profile
+        :raise TwistedPiValueError:
+        """
+        try:
+            return self._profiles[_name]
+        except (KeyError, TypeError):
+            raise TwistedPiValueError('Unknown profile',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+    def resolve(self, _args):
+        """
+        Expand the ``profile`` named in the request arguments.
+
+        :param _args: Request arguments, the profile name is removed
+        :return: A tuple with the image arguments and their apply plan, the
+                 plan is None if the request does not use a profile
+        :raise TwistedPiValueError:
+        """
+        if not 'profile' in _args:
+            return _args, None
+
+        profile = self.get(_args.pop('profile'))
+        profile.uses += 1
+
+        return profile.resolve(_args)
+
+    def most_used(self):
+        """
+
+        :return: The most used Profile, or None if no profile has been used
+        """
+        profiles = [profile for profile in self._profiles.values()
+                    if profile.uses > 0]
+        if not profiles:
+            return None
+
+        return max(profiles, key=lambda profile: profile.uses)
+
+    def describe(self):
+        """
+
+        :return: A dictionary describing every profile by name
+        """
+        return dict([(name, profile.describe())
+                     for name, profile in self._profiles.items()])
+
+    def load(self, _path):
+        """
+        Define the profiles found in a JSON file mapping profile names to
+        image arguments.
+
+        :param _path: Path of the file
+        :raise TwistedPiValueError:
+        """
+        try:
+            with open(_path) as f:
+                profiles = json.load(f)
+        except (IOError, ValueError) as _e:
+            raise TwistedPiValueError('Invalid profile file {0}: {1}'.format(
+                _path, _e), ErrorCodes.BAD_DATA)
+
+        if not isinstance(profiles, dict):
+            raise TwistedPiValueError('Invalid profile file {0}'.format(_path),
+                                      ErrorCodes.BAD_DATA)
+
+        for name, args in profiles.items():
+            self.define(name, args)
+
+        _log.info('Loaded {0} profiles from {1}', len(profiles), _path)
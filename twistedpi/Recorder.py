@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recorder module
+"""
+
+#Twisted modules
+from twisted.application import service
+from twisted.internet import reactor, task
+from twisted.python import log
+
+import os
+import time
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException, TwistedPiValueError
+from Log import Logger
+import Scheduler
+
+
+_log = Logger(__name__)
+
+#Default length of the recorded video kept in memory, in seconds
+DEFAULT_SECONDS = 20
+
+#Default bitrate of the recorded video
+DEFAULT_BITRATE = 4000000
+
+#Splitter port recorded from, leaving port 0 to the video captures
+SPLITTER_PORT = 1
+
+#Size of the chunks a clip is sent in
+CHUNK_SIZE = 256 * 1024
+
+
+class Recorder(service.Service):
+    """
+    Record H.264 video continuously into an in-memory circular buffer, so
+    that a clip can include the moments before the request for it.
+
+    The recording runs on a splitter port of the persistent camera session,
+    captures keep working while it runs but can not change the resolution.
+
+    :param _factory: The ImageServerFactory owning the camera
+    :param _seconds: Length of the buffer, in seconds
+    :param _bitrate: Bitrate of the video
+    :param _clipDirectory: Directory receiving saved clips, or None
+    """
+
+    def __init__(self, _factory, _seconds=DEFAULT_SECONDS,
+                 _bitrate=DEFAULT_BITRATE, _clipDirectory=None):
+        self.factory = _factory
+        self.seconds = _seconds
+        self.bitrate = _bitrate
+        self.clip_directory = _clipDirectory
+
+        #False once the backend has refused to record
+        self.supported = True
+        self._starting = False
+
+        self.triggers = 0
+        self.clips = 0
+        self.saved = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._startRecording()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.factory.camera_pool.callInThread(
+            self.factory.camera.stop_recording)
+
+    def _startRecording(self):
+        if self._starting or not self.supported:
+            return
+
+        _log.info('Recording the last {0} seconds', self.seconds)
+        self._starting = True
+
+        def started(_):
+            self._starting = False
+
+        def startError(_err):
+            self._starting = False
+            if _err.check(TwistedPiException) and \
+                    _err.value.code == ErrorCodes.BAD_REQUEST:
+                #The backend can not record, do not try again
+                _log.warning('Recording disabled: {0}', _err.value.msg)
+                self.supported = False
+            else:
+                log.err(_err)
+
+        camera = self.factory.camera
+        d = self.factory.scheduler.schedule(Scheduler.PRIORITY_INTERACTIVE,
+                                            None, camera.start_recording,
+                                            self.seconds, self.bitrate,
+                                            SPLITTER_PORT)
+        d.addCallbacks(started, startError)
+
+    def _checkSupported(self):
+        if not self.supported:
+            raise TwistedPiException('Recording is not supported',
+                                     ErrorCodes.BAD_REQUEST)
+
+    def clip(self, _seconds):
+        """
+        Copy the most recent video.
+
+        :param _seconds: Length of the clip, in seconds
+        :return: A Deferred firing with the H.264 video
+        :raise TwistedPiException:
+        """
+        if not 0 < _seconds <= self.seconds:
+            raise TwistedPiValueError('Invalid clip length',
+                                      ErrorCodes.BAD_REQUEST)
+
+        self._checkSupported()
+
+        if not self.factory.camera.is_recording:
+            #The camera failed and was reopened, start over
+            if self.running:
+                self._startRecording()
+            raise TwistedPiException('Not recording', ErrorCodes.BUSY)
+
+        self.clips += 1
+        return self.factory.encode(self.factory.camera.copy_recording,
+                                   _seconds)
+
+    def trigger(self, _before, _after):
+        """
+        Copy the video recorded from ``_before`` seconds before now until
+        ``_after`` seconds from now, once it has been recorded.
+
+        :param _before: Seconds of video before the trigger
+        :param _after: Seconds of video after the trigger
+        :return: A Deferred firing with the H.264 video
+        :raise TwistedPiException:
+        """
+        if _before < 0 or _after < 0 or \
+                not 0 < _before + _after <= self.seconds:
+            raise TwistedPiValueError('Invalid clip length',
+                                      ErrorCodes.BAD_REQUEST)
+
+        self._checkSupported()
+
+        self.triggers += 1
+        return task.deferLater(reactor, _after, self.clip, _before + _after)
+
+    def save(self, _clip):
+        """
+        Write a clip to the clip directory.
+
+        :param _clip: The H.264 video
+        :return: A Deferred firing with the path and size of the saved clip
+        :raise TwistedPiException:
+        """
+        if self.clip_directory is None:
+            raise TwistedPiException('No clip directory configured',
+                                     ErrorCodes.BAD_REQUEST)
+
+        path = os.path.join(self.clip_directory,
+                            'clip-{0:.3f}.h264'.format(time.time()))
+
+        def write():
+            if not os.path.isdir(self.clip_directory):
+                os.makedirs(self.clip_directory)
+            with open(path, 'wb') as clip:
+                clip.write(_clip)
+
+        def written(_):
+            self.saved += 1
+            return dict([('path', path), ('size', len(_clip))])
+
+        d = self.factory.encode(write)
+        d.addCallback(written)
+        return d
+
+    def stats(self):
+        """
+
+        :return: A dictionary with recorder statistics
+        """
+        return dict([('recording', int(self.factory.camera.is_recording)),
+                     ('seconds', self.seconds), ('triggers', self.triggers),
+                     ('clips', self.clips), ('saved', self.saved)])
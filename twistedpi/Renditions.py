@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Renditions module
+"""
+
+import io
+
+#Optional image library, without it renditions are not available
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiValueError
+import Schema
+
+
+#Names of the rendition formats in the image library
+_PIL_FORMATS = dict([('jpeg', 'JPEG'), ('png', 'PNG'), ('gif', 'GIF'),
+                     ('bmp', 'BMP')])
+
+#Image arguments that only affect the encoding of a capture
+_ENCODING_ARGS = ('format', 'quality', 'resize', 'thumbnail')
+
+
+def validate_renditions(_renditions):
+    """
+    Validate the renditions requested for an image. Renditions are produced
+    from a single raw capture and need the image library.
+
+    :param _renditions: A list with the arguments of every rendition
+    :return: A list of validated renditions
+    :raise TwistedPiValueError:
+    """
+    if not can_render():
+        raise TwistedPiValueError('Renditions need the image library',
+                                  ErrorCodes.BAD_REQUEST)
+
+    if not isinstance(_renditions, list) or \
+            not 0 < len(_renditions) <= Schema.MAX_RENDITIONS:
+        raise TwistedPiValueError('Invalid renditions',
+                                  ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+    renditions = list()
+    for rendition in _renditions:
+        if not isinstance(rendition, dict):
+            raise TwistedPiValueError('Invalid rendition',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        for key in rendition:
+            if not key in Schema.RENDITION_SCHEMA:
+                raise TwistedPiValueError('Unknown rendition argument',
+                                          ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        rendition = Schema.validate(Schema.RENDITION_SCHEMA, dict(rendition))
+
+        crop = rendition.get('crop', None)
+        if crop is not None and (crop[2] <= 0 or crop[3] <= 0):
+            raise TwistedPiValueError('Invalid crop',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        if not 'format' in rendition:
+            rendition['format'] = 'jpeg'
+
+        renditions.append(rendition)
+
+    return renditions
+
+
+def can_render():
+    """
+
+    :return: True if renditions can be produced from a single raw capture
+    """
+    return Image is not None
+
+
+def raw_args(_args):
+    """
+    Image arguments for the raw capture all renditions are produced from.
+
+    :param _args: Validated image arguments
+    :return: The arguments of an unscaled RGB capture
+    """
+    args = dict([(key, value) for key, value in _args.items()
+                 if not key in _ENCODING_ARGS])
+    args['format'] = 'rgb'
+
+    return args
+
+
+def raw_resolution(_resolution):
+    """
+    The camera pads raw frames to a width divisible by 32 and a height
+    divisible by 16.
+
+    :param _resolution: Resolution of the capture
+    :return: Size of the raw frame
+    """
+    width, height = _resolution
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+def rendition_settings(_settings, _renditions):
+    """
+    Describe the renditions in the settings of a capture.
+
+    :param _settings: Settings in effect for the capture
+    :param _renditions: The validated renditions
+    :return: A dictionary of settings
+    """
+    settings = dict([(key, value) for key, value in _settings.items()
+                     if not key in _ENCODING_ARGS])
+    settings['renditions'] = _renditions
+
+    return settings
+
+
+def render(_data, _resolution, _renditions):
+    """
+    Produce every rendition from a raw RGB frame. CPU bound, should run in
+    the encode pool.
+
+    :param _data: The raw frame
+    :param _resolution: Resolution of the capture
+    :param _renditions: The validated renditions
+    :return: A list with the encoded renditions
+    """
+    image = Image.frombuffer('RGB', raw_resolution(_resolution), _data, 'raw',
+                             'RGB', 0, 1)
+    if image.size != tuple(_resolution):
+        image = image.crop((0, 0) + tuple(_resolution))
+
+    return [_render(image, rendition) for rendition in _renditions]
+
+
+def _render(_image, _rendition):
+    image = _image
+
+    crop = _rendition.get('crop', None)
+    if crop is not None:
+        width, height = image.size
+        x, y, w, h = crop
+        box = (int(x * width), int(y * height),
+               int(min(x + w, 1.0) * width), int(min(y + h, 1.0) * height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise TwistedPiValueError('Invalid crop',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+        image = image.crop(box)
+
+    resize = _rendition.get('resize', None)
+    if resize is not None:
+        image = image.resize(tuple(resize), Image.BILINEAR)
+
+    options = dict()
+    if _rendition['format'] == 'jpeg':
+        options['quality'] = _rendition.get('quality', 85)
+
+    stream = io.BytesIO()
+    image.save(stream, _PIL_FORMATS[_rendition['format']], **options)
+
+    return stream.getvalue()
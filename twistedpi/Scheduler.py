@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scheduler module
+"""
+
+#Twisted modules
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, fail
+from twisted.python.failure import Failure
+
+import heapq
+import itertools
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException, TwistedPiValueError
+from Log import Logger
+from Metrics import MetricsRegistry
+
+
+#Job priorities, lower values run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITIES = dict([('interactive', PRIORITY_INTERACTIVE),
+                   ('normal', PRIORITY_NORMAL),
+                   ('background', PRIORITY_BACKGROUND)])
+
+#Default number of jobs allowed to wait for the camera
+DEFAULT_QUEUE_SIZE = 32
+
+#Weight of the latest job when updating the average job duration
+_SMOOTHING = 0.2
+
+_log = Logger(__name__)
+
+
+def parse_priority(_value):
+    """
+    Convert a priority given by a client to a scheduler priority.
+
+    :param _value: A priority name, or None for the default priority
+    :return: A priority
+    :raise TwistedPiValueError:
+    """
+    if _value is None:
+        return PRIORITY_NORMAL
+
+    try:
+        return PRIORITIES[_value]
+    except (KeyError, TypeError):
+        raise TwistedPiValueError('Invalid priority', ErrorCodes.BAD_REQUEST)
+
+
+def parse_deadline(_value):
+    """
+    Validate a deadline given by a client.
+
+    :param _value: Seconds, or None for no deadline
+    :return: The deadline
+    :raise TwistedPiValueError:
+    """
+    if _value is not None and (not isinstance(_value, (int, float))
+                               or isinstance(_value, bool) or _value < 0):
+        raise TwistedPiValueError('Invalid deadline', ErrorCodes.BAD_REQUEST)
+
+    return _value
+
+
+class _Job(object):
+    def __init__(self, _priority, _queued, _expires, _function, _args):
+        self.priority = _priority
+        self.queued = _queued
+        self.expires = _expires
+        self.function = _function
+        self.args = _args
+        self.deferred = Deferred()
+        self.timer = None
+
+    def cancelTimer(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
+class CaptureScheduler(object):
+    """
+    Run camera jobs one at a time in priority order.
+
+    The queue is bounded. When it is full a new job either replaces the
+    lowest priority job waiting, if it has a higher priority, or is refused.
+    A job may have a deadline, the time in seconds it is willing to wait
+    before it starts. A job that can not be expected to start in time is
+    refused immediately, and a job whose deadline passes while it waits is
+    dropped at its deadline. Refused and dropped jobs fail with ``BUSY``.
+
+    :param _threadpool: Thread pool running the jobs, should have a single
+                        thread so that the camera is owned by one thread
+    :param _maxQueue: Maximum number of waiting jobs
+    :param _clock: Provider of the current time
+    :param _metrics: Registry for the queue wait times
+    """
+
+    def __init__(self, _threadpool, _maxQueue=DEFAULT_QUEUE_SIZE,
+                 _clock=reactor, _metrics=None):
+        self.threadpool = _threadpool
+        self.max_queue = _maxQueue
+        self.clock = _clock
+        self.metrics = _metrics if _metrics is not None else MetricsRegistry()
+
+        self.running = False
+        self.average = 0.0
+
+        self.scheduled = 0
+        self.shed = 0
+        self.expired = 0
+
+        self._queue = list()
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stats(self):
+        """
+
+        :return: A dictionary with scheduler statistics
+        """
+        return dict([('queued', len(self._queue)),
+                     ('max_queue', self.max_queue),
+                     ('running', int(self.running)),
+                     ('average', self.average), ('scheduled', self.scheduled),
+                     ('shed', self.shed), ('expired', self.expired)])
+
+    def schedule(self, _priority, _deadline, _function, *_args):
+        """
+        Schedule a job.
+
+        :param _priority: Job priority
+        :param _deadline: Maximum time to wait before starting, or None
+        :param _function: Blocking callable, run in the camera thread
+        :param _args: Arguments for the callable
+        :return: A Deferred firing with the result of the callable
+        """
+        if _deadline is not None and self._expectedWait(_priority) > _deadline:
+            self.shed += 1
+            return fail(self._busy('Deadline can not be met'))
+
+        if len(self._queue) >= self.max_queue and not self._shedJob(_priority):
+            self.shed += 1
+            return fail(self._busy('Capture queue full'))
+
+        now = self.clock.seconds()
+
+        expires = None
+        if _deadline is not None:
+            expires = now + _deadline
+
+        job = _Job(_priority, now, expires, _function, _args)
+        heapq.heappush(self._queue, (_priority, next(self._sequence), job))
+        self.scheduled += 1
+
+        if _deadline is not None:
+            job.timer = self.clock.callLater(_deadline, self._expire, job)
+
+        self._runNext()
+
+        return job.deferred
+
+    def promote(self, _deferred, _priority, _deadline):
+        """
+        Let a waiting job serve another request. The job takes the higher
+        of the two priorities and the later of the two deadlines, a request
+        without a deadline removes the deadline of the job. The deadline of
+        every request served by the job has to be enforced by the caller,
+        see ``waiting``.
+
+        :param _deferred: The Deferred returned when the job was scheduled
+        :param _priority: Priority of the other request
+        :param _deadline: Deadline of the other request, or None
+        :return: True if the job was still waiting
+        """
+        for index, (priority, sequence, job) in enumerate(self._queue):
+            if job.deferred is _deferred:
+                break
+        else:
+            return False
+
+        if _priority < priority:
+            job.priority = _priority
+            self._queue[index] = (_priority, sequence, job)
+            heapq.heapify(self._queue)
+
+        if job.expires is not None:
+            job.cancelTimer()
+
+            if _deadline is None:
+                job.expires = None
+            else:
+                now = self.clock.seconds()
+                job.expires = max(job.expires, now + _deadline)
+                job.timer = self.clock.callLater(job.expires - now,
+                                                 self._expire, job)
+
+        return True
+
+    def waiting(self, _deferred):
+        """
+
+        :param _deferred: The Deferred returned when a job was scheduled
+        :return: True if the job has not started yet
+        """
+        return any([job.deferred is _deferred for _, _, job in self._queue])
+
+    def _busy(self, _msg):
+        return TwistedPiException(_msg, ErrorCodes.BUSY)
+
+    def _expectedWait(self, _priority):
+        ahead = len([job for priority, _, job in self._queue
+                     if priority <= _priority])
+        if self.running:
+            ahead += 1
+
+        return ahead * self.average
+
+    def _shedJob(self, _priority):
+        #Drop the newest of the lowest priority jobs to make room
+        worst = max(self._queue)
+        if worst[0] <= _priority:
+            return False
+
+        self._queue.remove(worst)
+        heapq.heapify(self._queue)
+
+        _log.debug('Shedding queued capture')
+        self.shed += 1
+        worst[2].cancelTimer()
+        worst[2].deferred.errback(self._busy('Capture queue full'))
+        return True
+
+    def _expire(self, _job):
+        #The deadline of a waiting job passed
+        _job.timer = None
+        for entry in self._queue:
+            if entry[2] is _job:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                break
+        else:
+            return
+
+        _log.debug('Dropping expired capture')
+        self.expired += 1
+        _job.deferred.errback(self._busy('Deadline expired'))
+
+    def _runNext(self):
+        while not self.running and self._queue:
+            _, _, job = heapq.heappop(self._queue)
+            job.cancelTimer()
+
+            started = self.clock.seconds()
+            if job.expires is not None and started > job.expires:
+                self.expired += 1
+                job.deferred.errback(self._busy('Deadline expired'))
+                continue
+
+            self.running = True
+            self.metrics.observe('queue_wait', started - job.queued)
+
+            d = threads.deferToThreadPool(reactor, self.threadpool,
+                                          job.function, *job.args)
+            d.addBoth(self._jobDone, job, started)
+
+    def _jobDone(self, _result, _job, _started):
+        duration = self.clock.seconds() - _started
+        self.average += _SMOOTHING * (duration - self.average)
+
+        #Answer the finished job before the next one takes the camera
+        if isinstance(_result, Failure):
+            _job.deferred.errback(_result)
+        else:
+            _job.deferred.callback(_result)
+
+        self.running = False
+        self._runNext()
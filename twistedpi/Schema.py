@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Schema module
+"""
+
+import numbers
+import types
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiValueError
+
+
+class Field(object):
+    """
+    Describes the values accepted for a single argument.
+
+    :param _nullable: True if None is accepted
+    """
+
+    def __init__(self, _nullable=False):
+        self.nullable = _nullable
+
+    def accepts(self, _value):
+        """
+
+        :param _value:
+        :return: True if the value is valid
+        """
+        if _value is None:
+            return self.nullable
+
+        return self._accepts(_value)
+
+    def _accepts(self, _value):
+        raise NotImplementedError()
+
+
+class Boolean(Field):
+    def _accepts(self, _value):
+        return isinstance(_value, bool)
+
+
+class Integer(Field):
+    """
+    :param _min: Smallest accepted value, or None
+    :param _max: Largest accepted value, or None
+    """
+
+    def __init__(self, _min=None, _max=None, _nullable=False):
+        Field.__init__(self, _nullable)
+        self.min = _min
+        self.max = _max
+
+    def _isNumber(self, _value):
+        return (isinstance(_value, numbers.Integral)
+                and not isinstance(_value, bool))
+
+    def _accepts(self, _value):
+        if not self._isNumber(_value):
+            return False
+
+        return ((self.min is None or _value >= self.min)
+                and (self.max is None or _value <= self.max))
+
+
+class Number(Integer):
+    def _isNumber(self, _value):
+        return (isinstance(_value, numbers.Real)
+                and not isinstance(_value, bool))
+
+
+class Choice(Field):
+    """
+    :param _choices: The accepted values
+    """
+
+    def __init__(self, _choices, _nullable=False):
+        Field.__init__(self, _nullable)
+        self.choices = frozenset(_choices)
+
+    def _accepts(self, _value):
+        #No choice is a boolean, but True and False equal 1 and 0
+        if isinstance(_value, bool):
+            return False
+
+        try:
+            return _value in self.choices
+        except TypeError:
+            return False
+
+
+class Sequence(Field):
+    """
+    A list with a fixed number of items.
+
+    :param _items: One Field per item
+    """
+
+    def __init__(self, _items, _nullable=False):
+        Field.__init__(self, _nullable)
+        self.items = tuple(_items)
+
+    def _accepts(self, _value):
+        if not isinstance(_value, (list, tuple)):
+            return False
+
+        if len(_value) != len(self.items):
+            return False
+
+        for field, value in zip(self.items, _value):
+            if not field.accepts(value):
+                return False
+
+        return True
+
+
+class StringList(Field):
+    """
+    A list of at least one string.
+    """
+
+    def _accepts(self, _value):
+        if not isinstance(_value, list) or not _value:
+            return False
+
+        for item in _value:
+            if not isinstance(item, types.StringTypes):
+                return False
+
+        return True
+
+
+class StringMapping(Field):
+    def _accepts(self, _value):
+        if not isinstance(_value, dict):
+            return False
+
+        for key, value in _value.items():
+            if not isinstance(key, types.StringTypes):
+                return False
+            if not isinstance(value, types.StringTypes):
+                return False
+
+        return True
+
+
+def validate(_schema, _args, _code=ErrorCodes.INVALID_CAMERA_ARGUMENT):
+    """
+    Check the arguments against a schema. Arguments the schema does not
+    describe are left alone.
+
+    :param _schema: A dictionary of Fields by argument name
+    :param _args:
+    :param _code: Error code of an invalid argument
+    :return: The arguments
+    :raise TwistedPiValueError:
+    """
+    for name, value in _args.items():
+        field = _schema.get(name, None)
+        if field is not None and not field.accepts(value):
+            raise TwistedPiValueError('Invalid {0}'.format(name), _code)
+
+    return _args
+
+
+#Largest resolution of any camera module
+MAX_WIDTH = 4056
+MAX_HEIGHT = 3040
+
+AWB_MODES = ('off', 'auto', 'sunlight', 'cloudy', 'shade', 'tungsten',
+             'fluorescent', 'incandescent', 'flash', 'horizon')
+
+EXPOSURE_MODES = ('off', 'auto', 'night', 'nightpreview', 'backlight',
+                  'spotlight', 'sports', 'snow', 'beach', 'verylong',
+                  'fixedfps', 'antishake', 'fireworks')
+
+METER_MODES = ('average', 'spot', 'backlit', 'matrix')
+
+IMAGE_FORMATS = ('jpeg', 'png', 'gif', 'bmp', 'yuv', 'rgb', 'rgba', 'bgr',
+                 'bgra')
+
+_SIZE = Sequence([Integer(1, MAX_WIDTH), Integer(1, MAX_HEIGHT)])
+
+#Every image argument understood by the camera
+IMAGE_SCHEMA = dict([
+    ('resolution', _SIZE),
+    ('ISO', Choice([0, 100, 200, 320, 400, 500, 640, 800, 1600])),
+    ('awb_mode', Choice(AWB_MODES)),
+    ('brightness', Integer(0, 100)),
+    ('color_effects', Sequence([Integer(0, 255), Integer(0, 255)],
+                               _nullable=True)),
+    ('contrast', Integer(-100, 100)),
+    ('crop', Sequence([Number(0, 1)] * 4)),
+    ('exposure_compensation', Integer(-25, 25)),
+    ('exposure_mode', Choice(EXPOSURE_MODES)),
+    ('hflip', Boolean()),
+    ('led', Boolean()),
+    ('meter_mode', Choice(METER_MODES)),
+    ('rotation', Choice([0, 90, 180, 270])),
+    ('saturation', Integer(-100, 100)),
+    ('sharpness', Integer(-100, 100)),
+    ('shutter_speed', Integer(0)),
+    ('vflip', Boolean()),
+    ('format', Choice(IMAGE_FORMATS)),
+    ('quality', Integer(1, 100)),
+    ('resize', Sequence(_SIZE.items, _nullable=True)),
+    ('thumbnail', Sequence([Integer(1, MAX_WIDTH), Integer(1, MAX_HEIGHT),
+                            Integer(1, 100)], _nullable=True)),
+    ('exif_tags', StringMapping()),
+])
+
+#Largest number of frames listed by a single LIST_FRAMES request
+MAX_FRAME_LIST = 1000
+
+#Arguments selecting stored timelapse frames
+FRAMES_SCHEMA = dict([
+    ('start', Number(_nullable=True)),
+    ('end', Number(_nullable=True)),
+    ('limit', Integer(1, MAX_FRAME_LIST)),
+    ('timestamp', Number()),
+])
+
+#Arguments of the clip commands
+CLIP_SCHEMA = dict([
+    ('seconds', Number(0)),
+    ('before', Number(0)),
+    ('after', Number(0)),
+    ('save', Boolean()),
+])
+
+#Largest number of renditions produced from a single capture
+MAX_RENDITIONS = 8
+
+RENDITION_FORMATS = ('jpeg', 'png', 'gif', 'bmp')
+
+#Arguments of a single output rendition of an image
+RENDITION_SCHEMA = dict([
+    ('format', Choice(RENDITION_FORMATS)),
+    ('quality', Integer(1, 100)),
+    ('resize', Sequence(_SIZE.items, _nullable=True)),
+    ('crop', Sequence([Number(0, 1)] * 4)),
+])
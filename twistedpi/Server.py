@@ -24,18 +24,34 @@ Server module
 
 #Twisted modules
 from twisted.internet.protocol import Factory
-from twisted.internet import threads
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
 from twisted.python import log
 from twisted.protocols.basic import NetstringReceiver
-from twisted.internet.defer import succeed, maybeDeferred
+from twisted.internet.defer import Deferred, succeed, maybeDeferred
 
-import json
 import base64
-import logging
+import threading
+import time
 import types
 
 #Camera modules
+import Backends
+import Cache
 import Camera
+import Capture
+import Codecs
+import Hub
+import Log
+import Metrics
+import Motion
+import Profiles
+import Recorder
+import Renditions
+import Scheduler
+import Schema
+import Stream
+import Timelapse
 
 #twistedpi modules
 from errors import (ErrorCodes, TwistedPiException, TwistedPiMethodNotFound,
@@ -43,40 +59,57 @@ from errors import (ErrorCodes, TwistedPiException, TwistedPiMethodNotFound,
 from twistedpi import __VERSION__, __NAME__
 
 
-__logger = logging.getLogger(__name__)
+_log = Log.Logger(__name__)
 
 VERBOSE = 5
 
+#Default number of threads encoding responses
+DEFAULT_ENCODE_THREADS = 2
 
-def DecodeRequest(_request):
+#Response transports a client can negotiate. 'base64' embeds binary data in
+#the JSON response, 'binary' sends it raw in a netstring of its own.
+TRANSPORT_BASE64 = 'base64'
+TRANSPORT_BINARY = 'binary'
+TRANSPORTS = (TRANSPORT_BASE64, TRANSPORT_BINARY)
+
+#Largest number of frames a single BURST request may capture
+MAX_BURST_COUNT = 100
+
+#Largest number of requests a single connection may have in flight
+MAX_IN_FLIGHT = 16
+
+
+def DecodeRequest(_request, _codec=Codecs.JSON):
     """
 
     :param _request:
+    :param _codec: The codec of the connection
     :return: :raise TwistedPiValueError:
     """
-    log.msg('Decoding request')
+    _log.debug('Decoding request')
 
     try:
-        return json.loads(_request)
+        return _codec.decode(_request)
     except ValueError as _e:
-        log.err(_e)
-        raise TwistedPiValueError('Inavalid JSON', ErrorCodes.BAD_DATA)
+        _log.debug('Undecodable request: {0}', _e)
+        raise TwistedPiValueError('Invalid data', ErrorCodes.BAD_DATA)
     except Exception as _e:
         log.err(_e)
         raise
 
 
-def EncodeResult(_result):
+def EncodeResult(_result, _codec=Codecs.JSON):
     """
 
     :param _result:
+    :param _codec: The codec of the connection
     :return: :raise TwistedPiValueError:
     """
     try:
-        return json.dumps(_result)
-    except ValueError as _e:
+        return _codec.encode(_result)
+    except (TypeError, ValueError) as _e:
         log.err(_e)
-        raise TwistedPiValueError('Invalid JSON', ErrorCodes.BAD_DATA)
+        raise TwistedPiValueError('Invalid data', ErrorCodes.BAD_DATA)
 
 
 def ValidateRequest(_request):
@@ -85,7 +118,7 @@ def ValidateRequest(_request):
     :param _request:
     :return: :raise TwistedPiValueError:
     """
-    log.msg('Validating Request')
+    _log.debug('Validating Request')
 
     if not 'command' in _request or not isinstance (_request['command'], types.StringTypes):
         raise TwistedPiValueError('Missing command', ErrorCodes.BAD_REQUEST)
@@ -99,7 +132,7 @@ def PrepareRequest(_request):
     :param _request:
     :return: :raise:
     """
-    log.msg('Preparing Request {0}'.format(_request))
+    _log.debug('Preparing Request {0}', _request)
 
     try:
         _request['command'] = _request['command'].upper()
@@ -123,6 +156,9 @@ def ResponseSuccess(_result, **kwargs):
     response = dict([('command', kwargs['command'])])
     response['payload'] = _result
 
+    if 'id' in kwargs:
+        response['id'] = kwargs['id']
+
     return response
 
 
@@ -135,9 +171,12 @@ def ResponseFail(_fail, **kwargs):
     """
     _fail.trap(TwistedPiException)
 
-    response = dict([('command', kwargs['command'])])
+    response = dict([('command', kwargs.get('command', None))])
     response['error'] = dict()
 
+    if 'id' in kwargs:
+        response['id'] = kwargs['id']
+
     _error = _fail.value
     response['error']['code'] = _error.code
 
@@ -151,11 +190,83 @@ def EncodeData(_data):
     :return:
     """
     _data = base64.b64encode(_data)
-    log.msg('Encoded Length: {0}'.format(len(_data)))
+    _log.debug('Encoded Length: {0}', len(_data))
 
     return _data
 
 
+class BinaryPayload(object):
+    """
+    Binary data returned from a command handler.
+
+    How the data reaches the client depends on the transport negotiated for
+    the connection. The base64 encoding is cached so that a payload shared
+    between several responses is only encoded once.
+
+    :param _data: The raw bytes
+    :param _settings: Optional camera settings sent along with the data
+    """
+
+    def __init__(self, _data, _settings=None):
+        self.data = _data
+        self.settings = _settings
+        self._encoded = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def encoded(self):
+        """
+
+        :return: The base64 encoded data
+        """
+        with self._lock:
+            if self._encoded is None:
+                self._encoded = EncodeData(self.data)
+
+        return self._encoded
+
+
+class MultiPayload(object):
+    """
+    Several binary payloads returned together, such as the renditions of a
+    single capture. Sent like a BinaryPayload, with lists in place of the
+    single payload and size.
+
+    :param _payloads: A list of BinaryPayloads
+    :param _settings: Optional camera settings sent along with the data
+    """
+
+    def __init__(self, _payloads, _settings=None):
+        self.payloads = _payloads
+        self.settings = _settings
+
+    def __len__(self):
+        return sum([len(payload) for payload in self.payloads])
+
+
+def ThreadPoolStats(_pool):
+    """
+
+    :param _pool: A thread pool
+    :return: A dictionary with the size and load of the pool
+    """
+    return dict([('threads', _pool.max), ('working', len(_pool.working)),
+                 ('idle', len(_pool.waiters)), ('queued', _pool.q.qsize())])
+
+
+def _logError(_error):
+    #Refusals are part of normal operation under load, invalid requests are
+    #the client's fault, only server errors are errors of the server
+    if _error.code in (ErrorCodes.BUSY, ErrorCodes.TOO_MANY_REQUESTS):
+        _log.info('Request refused: {0}({1})', _error.msg, _error.code)
+    elif _error.code == ErrorCodes.SERVER_ERROR:
+        _log.error('Request failed: {0}({1})', _error.msg, _error.code)
+    else:
+        _log.warning('Invalid request: {0}({1})', _error.msg, _error.code)
+
+
 def LogServerFailure(_failure):
     """
 
@@ -166,23 +277,43 @@ def LogServerFailure(_failure):
 
 class JSONCommandProtocol(NetstringReceiver):
     """
+    Requests and responses are encoded with JSON unless another codec has
+    been negotiated. Requests on a connection are handled concurrently and
+    answered in the order they complete. A request may carry an ``id`` that is echoed in its
+    response. At most ``MAX_IN_FLIGHT`` requests may be in flight on a
+    connection, further requests are answered with ``TOO_MANY_REQUESTS``.
 
     :param _factory:
     """
 
     def __init__(self, _factory):
         self.factory = _factory
+        self.transport_mode = TRANSPORT_BASE64
+        self.in_flight = 0
+
+        #Codecs for incoming requests and outgoing responses. They differ
+        #between a codec change and the response to the NEGOTIATE request.
+        self.request_codec = Codecs.JSON
+        self.codec = Codecs.JSON
+        self._next_codec = None
+
+        #Id of the request being dispatched, only valid while a handler
+        #is being called.
+        self.current_id = None
 
     def connectionMade(self):
         """
 
         :return:
         """
-        log.msg('Connection opened')
+        _log.info('Connection opened')
         self.factory.connectionMade()
 
         #Send server information to client
-        d = succeed(dict([('version', __VERSION__), ('name', __NAME__)]))
+        d = succeed(dict([('version', __VERSION__), ('name', __NAME__),
+                          ('transports', TRANSPORTS),
+                          ('codecs', sorted(Codecs.CODECS)),
+                          ('max_in_flight', MAX_IN_FLIGHT)]))
         d.addCallbacks(self._finalizeRequest, LogServerFailure)
         return d
 
@@ -191,7 +322,7 @@ class JSONCommandProtocol(NetstringReceiver):
 
         :param _reason:
         """
-        log.msg('Connection lost: {0}'.format(_reason))
+        _log.info('Connection lost: {0}', _reason)
         self.factory.connectionLost()
 
     def _handleCommand(self, _request):
@@ -199,109 +330,967 @@ class JSONCommandProtocol(NetstringReceiver):
         function = getattr(self, 'handle_{0}'.format(command), None)
 
         if callable(function):
-            return  maybeDeferred(function, _request['args'])
+            self.current_id = _request.get('id', None)
+            try:
+                return maybeDeferred(function, _request['args'])
+            finally:
+                self.current_id = None
         else:
-            log.msg('No command found')
+            _log.debug('No command found')
             msg = 'Invalid command {0}'.format(command)
-            raise TwistedPiMethodNotFound(msg, ErrorCodes.INVALID_COMMAND)
+            raise TwistedPiMethodNotFound(msg, ErrorCodes.INVALID_COMMAND,
+                                          command)
+
+    def _admitRequest(self, _request):
+        if self.in_flight >= MAX_IN_FLIGHT:
+            raise TwistedPiException('Too many requests in flight',
+                                     ErrorCodes.TOO_MANY_REQUESTS)
+
+        self.in_flight += 1
+
+        d = maybeDeferred(self._handleCommand, _request)
+        d.addBoth(self._requestDone)
+        return d
+
+    def _requestDone(self, _result):
+        self.in_flight -= 1
+        return _result
 
     def _sendResponse(self, _response):
-        log.msg('Sending Response. Size {0}'.format(len(_response)))
-        #log.msg('<--- {0}'.format(_response), logLevel=VERBOSE)
-        self.sendString(_response)
+        self._sendNetstring([_response])
+
+    def _sendNetstring(self, _parts):
+        #Write the parts as a single netstring without joining them, large
+        #payloads are handed to the transport as they are.
+        length = sum([len(part) for part in _parts])
+        _log.debug('Sending Response. Size {0}', length)
+
+        prefix = '{0}:'.format(length)
+        with self.factory.metrics.time('send'):
+            self.transport.writeSequence([prefix] + _parts + [','])
+
+        self.factory.metrics.increment('bytes_sent', len(prefix) + length + 1)
 
     def _finalizeRequest(self, _result):
-        result = EncodeResult(_result)
+        payload = _result.get('payload', None)
+
+        if isinstance(payload, (BinaryPayload, MultiPayload)):
+            if payload.settings is not None:
+                _result['settings'] = payload.settings
+
+            single = isinstance(payload, BinaryPayload)
+            payloads = [payload] if single else payload.payloads
+
+            def pack(_values):
+                return _values[0] if single else _values
+
+            if self.codec.binary:
+                #The codec carries the raw data
+                _result['payload'] = pack([Codecs.Binary(p.data)
+                                           for p in payloads])
+                self._sendResponse(EncodeResult(_result, self.codec))
+                return
+
+            if self.transport_mode == TRANSPORT_BINARY:
+                #Header first, then the raw data in netstrings of their own
+                del _result['payload']
+                _result['binary'] = pack([len(p) for p in payloads])
+
+                self._sendResponse(EncodeResult(_result, self.codec))
+                for p in payloads:
+                    self._sendResponse(p.data)
+                return
+
+            def encode():
+                return pack([p.encoded() for p in payloads])
+
+            d = self.factory.encode(
+                self.factory.metrics.timed('encode', encode))
+            d.addCallback(self._sendEncodedPayload, _result)
+            return d
+
+        result = EncodeResult(_result, self.codec)
         self._sendResponse(result)
 
+        if self._next_codec is not None and \
+                _result.get('command', None) == 'NEGOTIATE':
+            #Everything after the NEGOTIATE response uses the new codec
+            self.codec, self._next_codec = self._next_codec, None
+
+    def _sendEncodedPayload(self, _data, _result):
+        if self.codec is not Codecs.JSON:
+            #The codec changed while the payload was being encoded
+            return self._finalizeRequest(dict(_result, payload=_data))
+
+        #Splice the base64 data into the JSON response instead of passing it
+        #through the JSON encoder, saving a copy of the whole payload.
+        del _result['payload']
+        head = EncodeResult(_result)
+
+        if not isinstance(_data, list):
+            self._sendNetstring([head[:-1], ', "payload": "', _data, '"}'])
+            return
+
+        parts = [head[:-1], ', "payload": [']
+        for i, data in enumerate(_data):
+            parts.extend([', "' if i else '"', data, '"'])
+        parts.append(']}')
+
+        self._sendNetstring(parts)
+
+    def handle_NEGOTIATE(self, _args):
+        """
+        Negotiate connection options with the client. A client that sends
+        ``transport: "binary"`` receives binary payloads as a JSON header,
+        with the payload size in ``binary``, followed by a netstring holding
+        the raw data.
+
+        A client that sends ``codec`` with one of the codecs listed in the
+        handshake switches the encoding of the connection. Requests following
+        the NEGOTIATE request and responses following its response use the
+        new codec. Binary codecs carry payloads natively in the response.
+
+        :param _args:
+        :return: The options in effect for the connection
+        :raise TwistedPiValueError:
+        """
+        if 'transport' in _args:
+            if not _args['transport'] in TRANSPORTS:
+                raise TwistedPiValueError('Unknown transport',
+                                          ErrorCodes.BAD_REQUEST)
+            self.transport_mode = _args['transport']
+
+        codec = self.request_codec
+        if 'codec' in _args:
+            codec = Codecs.get_codec(_args['codec'])
+            self.request_codec = self._next_codec = codec
+
+        return dict([('transport', self.transport_mode),
+                     ('codec', codec.name)])
+
+    def _countError(self, _failure):
+        code = 'unknown'
+        if _failure.check(TwistedPiException):
+            code = _failure.value.code
+            _logError(_failure.value)
+
+        self.factory.metrics.increment('errors', _labels=dict([('code', code)]))
+        return _failure
+
+    def _logAccess(self, _response, _started):
+        self.factory.access_log.record(_response, time.time() - _started)
+        return _response
+
+    def _recordLatency(self, _result, _started):
+        self.factory.metrics.observe('request', time.time() - _started)
+        return _result
+
     def stringReceived(self, _line):
-        log.msg('---> {0}'.format(_line), logLevel=logging.DEBUG)
+        _log.debug('---> {0}', _line)
+
+        metrics = self.factory.metrics
+        started = time.time()
 
         try:
-            request = DecodeRequest(_line)
+            with metrics.time('decode'):
+                request = DecodeRequest(_line, self.request_codec)
         except TwistedPiValueError as e:
-            log.err(e)
+            _logError(e)
+            metrics.increment('errors',
+                              _labels=dict([('code', ErrorCodes.BAD_DATA)]))
         else:
-            log.msg(request)
             #Prepare incoming request
             d = succeed(request)
-            d.addCallback(ValidateRequest)
-            d.addCallback(PrepareRequest)
+            d.addCallback(metrics.timed('validate', ValidateRequest))
+            d.addCallback(metrics.timed('prepare', PrepareRequest))
 
             #Handle request
-            d.addCallback(self._handleCommand)
+            d.addCallback(self._admitRequest)
+            d.addErrback(self._countError)
 
             #Prepare and handle result
             d.addCallbacks(ResponseSuccess, ResponseFail,
                            callbackKeywords=request, errbackKeywords=request)
+            d.addCallback(self._logAccess, started)
             d.addCallbacks(self._finalizeRequest, LogServerFailure)
+            d.addBoth(self._recordLatency, started)
 
             return d
 
 
 class CameraProtocol(JSONCommandProtocol):
+    def __init__(self, _factory):
+        JSONCommandProtocol.__init__(self, _factory)
+        self.streamer = None
+
+        #Tail of the pushed responses, each one is sent once the previous
+        #one has been sent
+        self._pushed = succeed(None)
+
+    def connectionLost(self, _reason):
+        """
+
+        :param _reason:
+        """
+        self.streamer = None
+        self.factory.hub.unsubscribe(self)
+        JSONCommandProtocol.connectionLost(self, _reason)
+
+    def pushResponse(self, _response):
+        """
+        Send a response that is not the answer to a request, such as a
+        frame or a published message. Pushed responses are sent in the
+        order they are pushed, a base64 payload is only encoded once the
+        previous response has been sent.
+
+        :param _response:
+        :return: A Deferred firing once the response has been sent
+        """
+        sent = Deferred()
+
+        def send(_):
+            d = maybeDeferred(self._finalizeRequest, _response)
+            d.addErrback(LogServerFailure)
+            d.addCallback(sent.callback)
+            return d
+
+        self._pushed.addCallback(send)
+        return sent
+
+    def whenPushed(self):
+        """
+
+        :return: A Deferred firing once every response pushed so far has
+                 been sent
+        """
+        sent = Deferred()
+        self._pushed.addCallback(sent.callback)
+        return sent
+
+    def sendFrame(self, _command, _data, _frame, _timestamp, _id=None):
+        """
+        Push a frame to the client.
+
+        :param _command: The command producing the frame
+        :param _data: The encoded image
+        :param _frame: Frame sequence number
+        :param _timestamp: Capture time
+        :param _id: Id of the request producing the frame
+        :return: A Deferred firing once the frame has been sent
+        """
+        response = dict([('command', _command), ('frame', _frame),
+                         ('timestamp', _timestamp),
+                         ('payload', BinaryPayload(_data))])
+        if _id is not None:
+            response['id'] = _id
+
+        return self.pushResponse(response)
+
+    def sendMessage(self, _message, _id=None):
+        """
+        Push a published message to the client.
+
+        :param _message: A response shared with other subscribers, copied
+                         before it is sent
+        :param _id: Id of the subscribing request
+        :return: A Deferred firing once the message has been sent
+        """
+        response = dict(_message)
+        if _id is not None:
+            response['id'] = _id
+
+        return self.pushResponse(response)
+
+    def sendChunks(self, _command, _data, _id=None):
+        """
+        Send binary data as a sequence of responses holding one chunk each,
+        numbered in ``chunk`` out of ``chunks``. A chunk is only prepared
+        once the previous one has been sent, so the chunks arrive in order
+        and only one chunk is encoded at a time.
+
+        :param _command: The command producing the data
+        :param _data: The data
+        :param _id: Id of the request producing the data
+        :return: A Deferred firing with the size of the data and the number
+                 of chunks once every chunk has been sent
+        """
+        size = Recorder.CHUNK_SIZE
+        count = max(1, (len(_data) + size - 1) // size)
+
+        def sendChunk(_, _number):
+            chunk = _data[_number * size:(_number + 1) * size]
+
+            response = dict([('command', _command), ('chunk', _number),
+                             ('chunks', count),
+                             ('payload', BinaryPayload(chunk))])
+            if _id is not None:
+                response['id'] = _id
+
+            return self.pushResponse(response)
+
+        d = succeed(None)
+        for number in range(count):
+            d.addCallback(sendChunk, number)
+        d.addCallback(lambda _: dict([('size', len(_data)),
+                                      ('chunks', count)]))
+
+        return d
+
+    def sendStreamError(self, _failure, _id=None):
+        """
+        Tell the client that the stream has stopped because of an error.
+
+        :param _failure:
+        :param _id: Id of the request that started the stream
+        """
+        self.streamer = None
+
+        request = dict([('command', 'STREAM')])
+        if _id is not None:
+            request['id'] = _id
+
+        self.pushResponse(ResponseFail(_failure, **request))
+
+    def _schedulingArgs(self, _args):
+        priority = Scheduler.parse_priority(_args.pop('priority', None))
+        deadline = Scheduler.parse_deadline(_args.pop('deadline', None))
+
+        return priority, deadline
+
     def handle_PING(self, _args):
         """
 
         :param _args:
         :return:
         """
-        log.msg('handle_PING', logLevel=logging.DEBUG)
+        _log.debug('handle_PING')
         return 'PONG'
 
-    def handle_IMAGE(self, _args):
+    def handle_METRICS(self, _args):
         """
+        Report server metrics, the stage latency histograms, the counters and
+        the current state of the cache, scheduler and thread pools.
 
         :param _args:
-        :return: :raise TwistedPiException:
+        :return:
         """
-        log.msg('handle_image', logLevel=logging.DEBUG)
-
-        def imageSuccess(_image):
-            assert _image is not None, "Image is None"
+        _log.debug('handle_METRICS')
+        return self.factory.metrics.snapshot()
 
-            log.msg('Image Size: {0} bytes'.format(_image.tell())
-                    ,logLevel = logging.DEBUG)
+    def handle_IMAGE(self, _args):
+        """
+        Capture an image. The camera settings in effect for the capture are
+        returned in ``settings``. If ``max_age`` is given, a cached image
+        captured with the same arguments at most ``max_age`` seconds ago may
+        be returned instead of a new capture. The capture is queued with
+        ``priority`` (interactive, normal or background) and fails with
+        ``BUSY`` if it can not start within ``deadline`` seconds. A request
+        naming a ``profile`` uses the settings of that profile, arguments
+        given in the request take precedence.
+
+        A request with ``renditions``, a list of output renditions each with
+        its own ``format``, ``quality``, ``resize`` and ``crop``, receives
+        every rendition of a single capture as a list of payloads. Renditions
+        need the image library, without it they are refused with
+        ``BAD_REQUEST``.
 
-            _image.seek(0)
-            return threads.deferToThread(EncodeData, _image.read())
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_image')
 
         def imageError(_err):
+            if _err.check(TwistedPiException):
+                return _err
+
             log.err(_err)
             raise TwistedPiException("Error capturing Image",
                                      ErrorCodes.SERVER_ERROR)
 
+        priority, deadline = self._schedulingArgs(_args)
+
+        max_age = _args.pop('max_age', None)
+        if not Schema.Number(0, _nullable=True).accepts(max_age):
+            raise TwistedPiValueError('Invalid max_age',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        renditions = _args.pop('renditions', None)
+        if renditions is not None:
+            renditions = Renditions.validate_renditions(renditions)
+
+        _args, plan = self.factory.profiles.resolve(_args)
         _args = Camera.validate_image_args(_args)
 
-        d = threads.deferToThread(Camera.take_image, _args)
-        d.addCallbacks(imageSuccess, imageError)
+        if renditions is not None:
+            _args['renditions'] = renditions
+
+        if max_age is not None:
+            image = self.factory.cache.get(Capture.normalize_args(_args),
+                                           max_age)
+            if image is not None:
+                return image
+
+        d = self.factory.coalescer.capture(_args, priority, deadline, plan)
+        d.addErrback(imageError)
 
         return d
 
+    def handle_DEFINE_PROFILE(self, _args):
+        """
+        Define a capture profile named ``name`` holding the image arguments
+        in ``settings``. A profile with the same name is replaced.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_DEFINE_PROFILE')
+
+        profile = self.factory.profiles.define(_args.get('name', None),
+                                               _args.get('settings', None))
+        return profile.describe()
+
+    def handle_LIST_PROFILES(self, _args):
+        """
+        List the capture profiles with their settings and use counts.
+
+        :param _args:
+        :return:
+        """
+        _log.debug('handle_LIST_PROFILES')
+        return self.factory.profiles.describe()
+
+    def _frameStore(self):
+        store = self.factory.frame_store
+        if store is None:
+            raise TwistedPiException('No frame store configured',
+                                     ErrorCodes.BAD_REQUEST)
+
+        return store
+
+    def handle_LIST_FRAMES(self, _args):
+        """
+        List the stored timelapse frames captured between ``start`` and
+        ``end``, both Unix timestamps and optional, at most ``limit`` frames
+        oldest first.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_LIST_FRAMES')
+
+        store = self._frameStore()
+        Schema.validate(Schema.FRAMES_SCHEMA, _args, ErrorCodes.BAD_REQUEST)
+
+        return store.frames(_args.get('start', None), _args.get('end', None),
+                            _args.get('limit', Schema.MAX_FRAME_LIST))
+
+    def handle_FETCH_FRAME(self, _args):
+        """
+        Fetch the first stored timelapse frame captured at or after
+        ``timestamp``. The capture time of the frame is returned in
+        ``settings``.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_FETCH_FRAME')
+
+        store = self._frameStore()
+        if not 'timestamp' in _args:
+            raise TwistedPiValueError('Missing timestamp',
+                                      ErrorCodes.BAD_REQUEST)
+        Schema.validate(Schema.FRAMES_SCHEMA, _args, ErrorCodes.BAD_REQUEST)
+
+        def frameRead(_result):
+            _timestamp, _data = _result
+            return BinaryPayload(_data, dict([('timestamp', _timestamp)]))
+
+        d = self.factory.encode(store.read, _args['timestamp'])
+        d.addCallback(frameRead)
+
+        return d
+
+    def handle_SUBSCRIBE(self, _args):
+        """
+        Subscribe to a ``channel`` of the hub. Every message published on
+        the channel is sent with the id of the SUBSCRIBE request: ``frames``
+        sends the frames of the shared video feed as FRAME responses and
+        ``motion``, when motion detection is enabled, sends MOTION events.
+        If the client falls behind the oldest queued messages are dropped.
+        A connection can not subscribe while it runs a stream.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_SUBSCRIBE')
+
+        if self.streamer is not None:
+            raise TwistedPiValueError('Stream running',
+                                      ErrorCodes.BAD_REQUEST)
+
+        channel = _args.get('channel', None)
+        self.factory.hub.subscribe(self, channel, self.current_id)
+
+        return dict([('channel', channel),
+                     ('queue', self.factory.hub.max_queue)])
+
+    def handle_UNSUBSCRIBE(self, _args):
+        """
+        Unsubscribe from a ``channel``, or from every channel if none is
+        given.
+
+        :param _args:
+        :return: :raise TwistedPiValueError:
+        """
+        _log.debug('handle_UNSUBSCRIBE')
+
+        if not self.factory.hub.unsubscribe(self, _args.get('channel', None)):
+            raise TwistedPiValueError('Not subscribed', ErrorCodes.BAD_REQUEST)
+
+        return dict()
+
+    def _recorder(self):
+        recorder = self.factory.recorder
+        if recorder is None:
+            raise TwistedPiException('Recording is not enabled',
+                                     ErrorCodes.BAD_REQUEST)
+
+        return recorder
+
+    def handle_TRIGGER(self, _args):
+        """
+        Take a clip of the recorded video from ``before`` seconds before the
+        trigger until ``after`` seconds after it. The clip is sent once the
+        time after the trigger has been recorded, as CLIP responses holding
+        a chunk of the H.264 video each, followed by a TRIGGER response with
+        the size of the clip. With ``save`` the clip is written to the clip
+        directory instead and its path returned.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_TRIGGER')
+
+        recorder = self._recorder()
+        Schema.validate(Schema.CLIP_SCHEMA, _args, ErrorCodes.BAD_REQUEST)
+
+        request_id = self.current_id
+
+        d = recorder.trigger(_args.get('before', recorder.seconds / 2.0),
+                             _args.get('after', 0))
+        if _args.get('save', False):
+            d.addCallback(recorder.save)
+        else:
+            d.addCallback(lambda _clip: self.sendChunks('CLIP', _clip,
+                                                        request_id))
+
+        return d
+
+    def handle_CLIP(self, _args):
+        """
+        Take a clip of the last ``seconds`` of recorded video. The clip is
+        sent as CLIP responses holding a chunk of the H.264 video each,
+        followed by a CLIP response with the size of the clip.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_CLIP')
+
+        recorder = self._recorder()
+        Schema.validate(Schema.CLIP_SCHEMA, _args, ErrorCodes.BAD_REQUEST)
+
+        request_id = self.current_id
+
+        d = recorder.clip(_args.get('seconds', recorder.seconds))
+        d.addCallback(lambda _clip: self.sendChunks('CLIP', _clip,
+                                                    request_id))
+
+        return d
+
+    def handle_BURST(self, _args):
+        """
+        Capture a burst of frames from the video port. Accepts the same
+        arguments as IMAGE plus ``count`` and ``interval``, the minimum time
+        between frames in seconds. Every frame is sent as soon as it is
+        captured as a BURST response with a frame number and a capture
+        timestamp, the final BURST response holds the number of frames and
+        the camera settings.
+
+        :param _args:
+        :return: :raise TwistedPiException:
+        """
+        _log.debug('handle_BURST')
+
+        priority, deadline = self._schedulingArgs(_args)
+
+        count = _args.pop('count', 10)
+        if not Schema.Integer(1, MAX_BURST_COUNT).accepts(count):
+            raise TwistedPiValueError('Invalid count',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        interval = _args.pop('interval', 0)
+        if not Schema.Number(0).accepts(interval):
+            raise TwistedPiValueError('Invalid interval',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        _args = Camera.validate_image_args(_args)
+
+        request_id = self.current_id
+
+        def frameReady(_data, _frame, _timestamp):
+            reactor.callFromThread(self.sendFrame, 'BURST', _data, _frame,
+                                   _timestamp, request_id)
+
+        def burstDone(_settings):
+            #The final response goes out after the last frame
+            d = self.whenPushed()
+            d.addCallback(lambda _: dict([('frames', count),
+                                          ('settings', _settings)]))
+            return d
+
+        d = self.factory.scheduler.schedule(priority, deadline,
+                                            self.factory.camera.take_burst,
+                                            _args, count, interval, frameReady)
+        d.addCallback(burstDone)
+
+        return d
+
+    def handle_STREAM(self, _args):
+        """
+        Start streaming frames from the video port. Accepts the same
+        arguments as IMAGE plus ``fps``. Every frame is sent as a STREAM
+        response with a frame number and a capture timestamp.
+
+        :param _args:
+        :return: :raise TwistedPiValueError:
+        """
+        _log.debug('handle_STREAM')
+
+        if self.streamer is not None:
+            raise TwistedPiValueError('Stream already running',
+                                      ErrorCodes.BAD_REQUEST)
+
+        if self.factory.hub.isSubscribed(self):
+            raise TwistedPiValueError('Subscribed to the hub',
+                                      ErrorCodes.BAD_REQUEST)
+
+        fps = _args.pop('fps', 5)
+        if not Schema.Number(0, Stream.MAX_STREAM_FPS).accepts(fps) or \
+                fps == 0:
+            raise TwistedPiValueError('Invalid fps',
+                                      ErrorCodes.INVALID_CAMERA_ARGUMENT)
+
+        _args = Camera.validate_image_args(_args)
+
+        self.streamer = Stream.FrameStreamer(self, self.factory.captureFrame,
+                                             _args, fps, self.current_id)
+        self.streamer.start()
+
+        return dict([('fps', fps)])
+
+    def handle_STOP_STREAM(self, _args):
+        """
+        Stop a running stream.
+
+        :param _args:
+        :return: :raise TwistedPiValueError:
+        """
+        _log.debug('handle_STOP_STREAM')
+
+        if self.streamer is None:
+            raise TwistedPiValueError('No stream running',
+                                      ErrorCodes.BAD_REQUEST)
+
+        streamer, self.streamer = self.streamer, None
+        streamer.stop()
+
+        #The final response goes out after the last frame
+        d = self.whenPushed()
+        d.addCallback(lambda _: dict([('frames', streamer.frames)]))
+        return d
+
 
 class ImageServerFactory(Factory):
     def __init__(self, _config):
-        log.msg('Creating Protocol Factory', logLevel=logging.DEBUG)
+        _log.debug('Creating Protocol Factory')
+
+        #All camera access happens in a single dedicated thread, encoding
+        #runs in a pool of its own so the two never compete for threads.
+        self.camera_pool = ThreadPool(1, 1, 'twistedpi-camera')
+        self.encode_pool = ThreadPool(
+            1, int(_config.get('encode-threads', DEFAULT_ENCODE_THREADS)),
+            'twistedpi-encode')
+
+        self.metrics = Metrics.MetricsRegistry()
+        self.access_log = Log.AccessLog(float(_config.get('access-log-sample',
+                                                          0.0)))
+        self.connections = 0
+
+        self.camera = Camera.CameraSession(Backends.create_backend(_config),
+                                           self.metrics)
+        self.scheduler = Scheduler.CaptureScheduler(
+            self.camera_pool,
+            int(_config.get('queue-size', Scheduler.DEFAULT_QUEUE_SIZE)),
+            _metrics=self.metrics)
+        self.cache = Cache.FrameCache(int(_config.get('cache-size',
+                                                      Cache.DEFAULT_CACHE_SIZE)))
+        self.coalescer = Capture.CaptureCoalescer(self.captureImage,
+                                                  self.joinCapture)
+
+        self.profiles = Profiles.ProfileRegistry()
+        if _config.get('profiles', None) is not None:
+            self.profiles.load(_config['profiles'])
+
+        self.frame_store = None
+        if _config.get('timelapse-dir', None) is not None:
+            self.frame_store = Timelapse.FrameStore(_config['timelapse-dir'])
+
+        self.hub = Hub.Hub(int(_config.get('subscriber-queue',
+                                           Hub.DEFAULT_QUEUE_SIZE)))
+        self.feed = Hub.FrameFeed(self.hub, self.captureFeedFrame,
+                                  float(_config.get('feed-fps',
+                                                    Hub.DEFAULT_FEED_FPS)))
+
+        self.recorder = None
+        if _config.get('record-seconds', None) is not None:
+            self.recorder = Recorder.Recorder(
+                self, float(_config['record-seconds']),
+                int(_config.get('record-bitrate', Recorder.DEFAULT_BITRATE)),
+                _config.get('clip-dir', None))
+
+        self.motion = None
+        if _config.get('motion-interval', None) is not None:
+            detector = Motion.MotionDetector(
+                _threshold=float(_config.get('motion-threshold',
+                                             Motion.DEFAULT_THRESHOLD)),
+                _area=float(_config.get('motion-area', Motion.DEFAULT_AREA)),
+                _regions=Motion.parse_regions(_config.get('motion-regions',
+                                                          None)))
+            self.motion = Motion.MotionService(
+                self, detector, float(_config['motion-interval']))
+
+        self.metrics.gauge('connections_open', lambda: self.connections)
+        self.metrics.gauge('cache', self.cache.stats)
+        self.metrics.gauge('scheduler', self.scheduler.stats)
+        self.metrics.gauge('coalescer', self.coalescer.stats)
+        self.metrics.gauge('pool', self.poolStats)
+        if self.frame_store is not None:
+            self.metrics.gauge('frame_store', self.frame_store.stats)
+        self.metrics.gauge('hub', self.hub.stats)
+        self.metrics.gauge('feed', self.feed.stats)
+        if self.motion is not None:
+            self.metrics.gauge('motion', self.motion.stats)
+        if self.recorder is not None:
+            self.metrics.gauge('recorder', self.recorder.stats)
 
     def doStart(self):
         """
-        TODO
+        Open the camera session so that the first capture does not have to
+        wait for the camera to warm up.
         """
-        log.msg('Factory.doStart...', logLevel=logging.DEBUG)
+        _log.debug('Factory.doStart...')
+
+        self.camera_pool.start()
+        self.encode_pool.start()
+
+        d = threads.deferToThreadPool(reactor, self.camera_pool,
+                                      self.camera.open)
+        d.addErrback(LogServerFailure)
 
     def doStop(self):
         """
-        TODO
+        Close the camera session and stop the worker threads.
+        """
+        _log.debug('Factory.doStop...')
+
+        #Stopping the pool waits for the close to run in the camera thread
+        self.camera_pool.callInThread(self.camera.close)
+        self.camera_pool.stop()
+        self.encode_pool.stop()
+
+    def encode(self, _function, *_args):
+        """
+        Run a CPU bound encoding or transformation in the encode pool.
+
+        :param _function:
+        :param _args:
+        :return: A Deferred firing with the result
+        """
+        return threads.deferToThreadPool(reactor, self.encode_pool,
+                                         _function, *_args)
+
+    def poolStats(self):
+        """
+
+        :return: A dictionary with the load of the camera and encode pools
+        """
+        return dict([('camera', ThreadPoolStats(self.camera_pool)),
+                     ('encode', ThreadPoolStats(self.encode_pool))])
+
+    def captureImage(self, _args, _priority=Scheduler.PRIORITY_NORMAL,
+                     _deadline=None, _plan=None):
+        """
+        Schedule an image capture with the camera session.
+
+        :param _args: Validated image arguments
+        :param _priority: Scheduling priority
+        :param _deadline: Maximum time to wait for the camera, or None
+        :param _plan: Precompiled camera settings for the arguments
+        :return: A Deferred firing with a BinaryPayload, or a MultiPayload
+                 if the arguments hold renditions
+        """
+        def imageSuccess(_result):
+            _image, _settings = _result
+            assert _image is not None, "Image is None"
+
+            _log.debug('Image Size: {0} bytes', len(_image))
+
+            return BinaryPayload(_image, _settings)
+
+        def captureDone(_image):
+            self.cache.put(Capture.normalize_args(_args), _image)
+            self._preconfigure()
+
+            return _image
+
+        if 'renditions' in _args:
+            d = self.captureRenditions(_args, _priority, _deadline, _plan)
+        else:
+            d = self.scheduler.schedule(_priority, _deadline,
+                                        self.camera.take_image, _args, False,
+                                        _plan)
+            d.addCallback(imageSuccess)
+        d.addCallback(captureDone)
+
+        return d
+
+    def joinCapture(self, _capture, _waiter,
+                    _priority=Scheduler.PRIORITY_NORMAL, _deadline=None,
+                    _plan=None):
+        """
+        Called for every request waiting for a capture. A capture still
+        waiting for the camera adopts the priority of the request if it is
+        more urgent, and keeps waiting as long as any of its requests is
+        willing to. A request whose own deadline passes before the capture
+        starts fails with ``BUSY`` on its own.
+
+        :param _capture: The Deferred returned by captureImage
+        :param _waiter: The Deferred returned to the request
+        :param _priority: Scheduling priority of the request
+        :param _deadline: Maximum time the request waits for the camera
+        :param _plan: Precompiled camera settings for the arguments
+        """
+        self.scheduler.promote(_capture, _priority, _deadline)
+        if _deadline is None:
+            return
+
+        def expired():
+            if not _waiter.called and self.scheduler.waiting(_capture):
+                self.scheduler.expired += 1
+                _waiter.errback(TwistedPiException('Deadline expired',
+                                                   ErrorCodes.BUSY))
+
+        call = self.scheduler.clock.callLater(_deadline, expired)
+
+        def answered(_result):
+            if call.active():
+                call.cancel()
+            return _result
+
+        _waiter.addBoth(answered)
+
+    def captureRenditions(self, _args, _priority, _deadline, _plan=None):
+        """
+        Schedule a single capture producing several renditions. The camera
+        takes one raw frame and the renditions are produced from it in the
+        encode pool.
+
+        :param _args: Validated image arguments holding the renditions
+        :param _priority: Scheduling priority
+        :param _deadline: Maximum time to wait for the camera, or None
+        :param _plan: Precompiled camera settings for the arguments
+        :return: A Deferred firing with a MultiPayload
+        """
+        args = dict(_args)
+        renditions = args.pop('renditions')
+
+        def renditionsDone(_images, _settings):
+            return MultiPayload([BinaryPayload(image) for image in _images],
+                                Renditions.rendition_settings(_settings,
+                                                              renditions))
+
+        def render(_result):
+            _data, _settings = _result
+
+            d = self.encode(self.metrics.timed('render', Renditions.render),
+                            _data, _settings['resolution'], renditions)
+            d.addCallback(renditionsDone, _settings)
+            return d
+
+        d = self.scheduler.schedule(_priority, _deadline,
+                                    self.camera.take_image,
+                                    Renditions.raw_args(args), False, _plan)
+        d.addCallback(render)
+
+        return d
+
+    def _preconfigure(self):
+        #Once the camera is idle, switch it to the resolution of the most
+        #used profile so that its captures skip the pipeline change. Only
+        #the resolution is pre-warmed, every capture applies its own
+        #settings.
+        profile = self.profiles.most_used()
+        if profile is None or len(self.scheduler):
+            return
+
+        resolution = dict(profile.plan).get('resolution', None)
+        if resolution is None or resolution == self.camera.resolution:
+            return
+
+        def preconfigureError(_err):
+            if _err.check(TwistedPiException):
+                _log.debug('Preconfigure skipped: {0}', _err.value.msg)
+            else:
+                LogServerFailure(_err)
+
+        d = self.scheduler.schedule(Scheduler.PRIORITY_BACKGROUND, None,
+                                    self.camera.preconfigure, resolution)
+        d.addErrback(preconfigureError)
+
+    def captureFrame(self, _args, _deadline=None):
+        """
+        Schedule a capture from the video port.
+
+        :param _args: Validated image arguments
+        :param _deadline: Maximum time to wait for the camera, or None
+        :return: A Deferred firing with the captured image and settings
         """
-        log.msg('Factory.doStop...', logLevel=logging.DEBUG)
+        return self.scheduler.schedule(Scheduler.PRIORITY_NORMAL, _deadline,
+                                       self.camera.take_image, _args, True)
+
+    def captureFeedFrame(self, _deadline=None):
+        """
+        Capture a frame for the shared frame feed.
+
+        :param _deadline: Maximum time to wait for the camera, or None
+        :return: A Deferred firing with a BinaryPayload
+        """
+        def frameCaptured(_result):
+            _image, _settings = _result
+            return BinaryPayload(_image, _settings)
+
+        d = self.captureFrame(dict([('format', 'jpeg')]), _deadline)
+        d.addCallback(frameCaptured)
+
+        return d
 
     def startConnecting(self, _connectorInstance):
         """
 
         :param _connectorInstance:
         """
-        log.msg('Start Connecting: {0}'.format(_connectorInstance),
-                logLevel=logger.DEBUG)
+        _log.debug('Start Connecting: {0}', _connectorInstance)
 
     def clientConnectionLost(self, _connection, _reason):
         """
@@ -309,7 +1298,7 @@ class ImageServerFactory(Factory):
         :param _connection:
         :param _reason:
         """
-        log.msg('{0} connection lost {1}'.format(_connection, _reason))
+        _log.info('{0} connection lost {1}', _connection, _reason)
 
 
     def buildProtocol(self, _addr):
@@ -318,8 +1307,7 @@ class ImageServerFactory(Factory):
         :param _addr:
         :return:
         """
-        log.msg('Creating Protocol for {0}'.format(_addr),
-                logLevel=logging.DEBUG)
+        _log.debug('Creating Protocol for {0}', _addr)
 
         return CameraProtocol(self)
 
@@ -327,16 +1315,17 @@ class ImageServerFactory(Factory):
         """
         TODO
         """
-        log.msg('Stopping Protocol Factory', logLevel=logging.DEBUG)
+        _log.debug('Stopping Protocol Factory')
 
     def connectionMade(self):
         """
-        TODO
+        Called by a protocol when its connection is made.
         """
-        pass
+        self.connections += 1
+        self.metrics.increment('connections')
 
     def connectionLost(self):
         """
-        TODO
+        Called by a protocol when its connection is lost.
         """
-        pass
+        self.connections -= 1
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stream module
+"""
+
+#Zope modules
+from zope.interface import implementer
+
+#Twisted modules
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet import task
+from twisted.python import log
+from twisted.python.failure import Failure
+
+import time
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException
+from Log import Logger
+
+
+#Highest frame rate a client may ask for
+MAX_STREAM_FPS = 30
+
+_log = Logger(__name__)
+
+
+@implementer(IPushProducer)
+class FrameStreamer(object):
+    """
+    Continuously capture frames from the camera video port and push them to
+    a protocol.
+
+    The streamer is registered as a streaming producer on the transport. When
+    the transport buffer fills up the transport pauses the streamer and no
+    frames are captured until the client has caught up, so a slow client
+    can not make the server buffer frames.
+
+    :param _protocol: The protocol receiving the frames
+    :param _capture: Callable taking image arguments and a deadline and
+                     returning a Deferred firing with a captured frame
+    :param _args: Validated image arguments
+    :param _fps: Frames per second
+    :param _id: Id of the request starting the stream
+    """
+
+    def __init__(self, _protocol, _capture, _args, _fps, _id=None):
+        self.protocol = _protocol
+        self.capture = _capture
+        self.args = _args
+        self.fps = _fps
+        self.id = _id
+
+        self.paused = False
+        self.frames = 0
+
+        self._loop = task.LoopingCall(self._captureFrame)
+
+    def start(self):
+        """
+        Register with the transport and start capturing frames.
+        """
+        _log.debug('Starting stream at {0} fps', self.fps)
+
+        self.protocol.transport.registerProducer(self, True)
+        d = self._loop.start(1.0 / self.fps)
+        d.addErrback(log.err)
+
+    def stop(self):
+        """
+        Stop capturing frames and unregister from the transport.
+        """
+        _log.debug('Stopping stream after {0} frames', self.frames)
+
+        self.stopProducing()
+        self.protocol.transport.unregisterProducer()
+
+    def _captureFrame(self):
+        if self.paused:
+            return
+
+        #The loop waits for the returned deferred, captures never overlap.
+        #A frame that can not be captured within one frame interval is
+        #skipped.
+        d = self.capture(self.args, 1.0 / self.fps)
+        d.addCallbacks(self._frameCaptured, self._frameFailed)
+        return d
+
+    def _frameCaptured(self, _result):
+        image, settings = _result
+
+        self.frames += 1
+        self.protocol.sendFrame('STREAM', image, self.frames,
+                                time.time(), self.id)
+
+    def _frameFailed(self, _failure):
+        if _failure.check(TwistedPiException) and \
+                _failure.value.code == ErrorCodes.BUSY:
+            _log.debug('Skipping frame, camera busy')
+            return
+
+        if self.protocol.streamer is not self:
+            #Already stopped by the client
+            return
+
+        self.stop()
+
+        if _failure.check(TwistedPiException):
+            _log.warning('Stream stopped: {0}', _failure.value.msg)
+        else:
+            log.err(_failure)
+            _failure = Failure(TwistedPiException('Stream failed',
+                                                  ErrorCodes.SERVER_ERROR))
+
+        #Clears the stream of the protocol so that a new one can be started
+        self.protocol.sendStreamError(_failure, self.id)
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its buffer is full.
+        """
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+        Called by the transport when its buffer has been drained.
+        """
+        self.paused = False
+
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost.
+        """
+        if self._loop.running:
+            self._loop.stop()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Timelapse module
+"""
+
+#Twisted modules
+from twisted.application import service
+from twisted.internet import task
+
+import bisect
+import os
+import struct
+import threading
+import time
+
+#twistedpi modules
+from errors import ErrorCodes, TwistedPiException
+from Log import Logger
+import Scheduler
+
+
+_log = Logger(__name__)
+
+#Size at which the store starts a new segment
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+#Default time between timelapse captures, in seconds
+DEFAULT_INTERVAL = 10.0
+
+#Index record: capture time, offset and length of the frame in the segment
+INDEX_RECORD = struct.Struct('<dQI')
+
+_DATA_SUFFIX = '.frames'
+_INDEX_SUFFIX = '.index'
+
+
+class _Segment(object):
+    def __init__(self, _path):
+        self.path = _path
+        self.size = 0
+
+    @property
+    def data_path(self):
+        return self.path + _DATA_SUFFIX
+
+    @property
+    def index_path(self):
+        return self.path + _INDEX_SUFFIX
+
+
+class FrameStore(object):
+    """
+    An append only store of timestamped frames on disk.
+
+    Frames are appended to segment files, the frames of a segment are
+    followed by an index file with one fixed size record per frame. The
+    timestamps of all frames are kept in memory in capture order, so a time
+    range is found with a binary search and a frame is read with a single
+    seek. Segments that were not closed cleanly are recovered up to the last
+    complete frame.
+
+    The store is safe to use from several threads.
+
+    :param _directory: Directory holding the segments, created if missing
+    :param _segmentSize: Size at which a new segment is started
+    """
+
+    def __init__(self, _directory, _segmentSize=DEFAULT_SEGMENT_SIZE):
+        self.directory = _directory
+        self.segment_size = _segmentSize
+
+        self._lock = threading.Lock()
+        self._segments = list()
+        self._times = list()
+        self._frames = list()
+
+        if not os.path.isdir(_directory):
+            os.makedirs(_directory)
+
+        self._load()
+
+    def __len__(self):
+        return len(self._times)
+
+    def _load(self):
+        names = sorted([name[:-len(_INDEX_SUFFIX)]
+                        for name in os.listdir(self.directory)
+                        if name.endswith(_INDEX_SUFFIX)])
+
+        for name in names:
+            segment = _Segment(os.path.join(self.directory, name))
+            if not os.path.isfile(segment.data_path):
+                continue
+
+            data_size = os.path.getsize(segment.data_path)
+            with open(segment.index_path, 'rb') as index:
+                records = index.read()
+
+            number = len(self._segments)
+            valid = 0
+            for start in range(0, len(records) - INDEX_RECORD.size + 1,
+                               INDEX_RECORD.size):
+                timestamp, offset, length = INDEX_RECORD.unpack_from(records,
+                                                                     start)
+                if offset + length > data_size:
+                    break
+                self._index(timestamp, number, offset, length)
+                segment.size = offset + length
+                valid = start + INDEX_RECORD.size
+
+            #Drop whatever an interrupted append left behind
+            if valid < len(records):
+                with open(segment.index_path, 'r+b') as index:
+                    index.truncate(valid)
+            if segment.size < data_size:
+                with open(segment.data_path, 'r+b') as data:
+                    data.truncate(segment.size)
+
+            self._segments.append(segment)
+
+        _log.info('Loaded {0} frames in {1} segments', len(self._times),
+                  len(self._segments))
+
+    def _index(self, _timestamp, _segment, _offset, _length):
+        #Frames normally arrive in time order, keep the index sorted if not
+        position = bisect.bisect_right(self._times, _timestamp)
+        self._times.insert(position, _timestamp)
+        self._frames.insert(position, (_segment, _offset, _length))
+
+    def _currentSegment(self, _timestamp):
+        if self._segments and \
+                self._segments[-1].size < self.segment_size:
+            return len(self._segments) - 1
+
+        name = '{0:017d}'.format(int(_timestamp * 1000))
+        self._segments.append(_Segment(os.path.join(self.directory, name)))
+
+        return len(self._segments) - 1
+
+    def append(self, _data, _timestamp=None):
+        """
+        Add a frame. Does disk I/O, should run in a worker thread.
+
+        :param _data: The frame
+        :param _timestamp: Capture time, defaults to now
+        :return: The timestamp of the frame
+        """
+        if _timestamp is None:
+            _timestamp = time.time()
+
+        with self._lock:
+            number = self._currentSegment(_timestamp)
+            segment = self._segments[number]
+            offset = segment.size
+
+            with open(segment.data_path, 'ab') as data:
+                data.write(_data)
+            with open(segment.index_path, 'ab') as index:
+                index.write(INDEX_RECORD.pack(_timestamp, offset, len(_data)))
+
+            segment.size = offset + len(_data)
+            self._index(_timestamp, number, offset, len(_data))
+
+        return _timestamp
+
+    def frames(self, _start=None, _end=None, _limit=None):
+        """
+        List the frames captured in a time range.
+
+        :param _start: Earliest capture time, or None
+        :param _end: Latest capture time, or None
+        :param _limit: Largest number of frames to list, or None
+        :return: A list of dictionaries with the timestamp and size of every
+                 frame, oldest first
+        """
+        with self._lock:
+            first = 0
+            if _start is not None:
+                first = bisect.bisect_left(self._times, _start)
+
+            last = len(self._times)
+            if _end is not None:
+                last = bisect.bisect_right(self._times, _end)
+
+            if _limit is not None:
+                last = min(last, first + _limit)
+
+            return [dict([('timestamp', self._times[i]),
+                          ('size', self._frames[i][2])])
+                    for i in range(first, max(first, last))]
+
+    def read(self, _timestamp):
+        """
+        Read the first frame captured at or after a time. Does disk I/O,
+        should run in a worker thread.
+
+        :param _timestamp: Capture time
+        :return: A tuple with the timestamp of the frame and the frame
+        :raise TwistedPiException:
+        """
+        with self._lock:
+            position = bisect.bisect_left(self._times, _timestamp)
+            if position == len(self._times):
+                raise TwistedPiException('No frame found',
+                                         ErrorCodes.NOT_FOUND)
+
+            timestamp = self._times[position]
+            number, offset, length = self._frames[position]
+            path = self._segments[number].data_path
+
+        with open(path, 'rb') as data:
+            data.seek(offset)
+            return timestamp, data.read(length)
+
+    def stats(self):
+        """
+
+        :return: A dictionary with store statistics
+        """
+        with self._lock:
+            return dict([('frames', len(self._times)),
+                         ('segments', len(self._segments)),
+                         ('bytes', sum([segment.size
+                                        for segment in self._segments]))])
+
+
+class TimelapseService(service.Service):
+    """
+    Capture frames at a fixed interval and add them to a frame store.
+
+    Captures are scheduled with background priority, so they never delay
+    client requests, and share a capture with any client request for the
+    same image. A capture that can not run is skipped.
+
+    :param _factory: The ImageServerFactory owning the camera
+    :param _store: The FrameStore receiving the frames
+    :param _interval: Time between captures, in seconds
+    :param _args: Image arguments of the captures
+    """
+
+    def __init__(self, _factory, _store, _interval=DEFAULT_INTERVAL,
+                 _args=None):
+        self.factory = _factory
+        self.store = _store
+        self.interval = _interval
+        self.args = _args if _args is not None else dict([('format', 'jpeg')])
+
+        self.captured = 0
+        self.skipped = 0
+
+        self._loop = task.LoopingCall(self.capture)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+
+    def capture(self):
+        """
+        Capture a frame and store it.
+
+        :return: A Deferred firing when the frame is stored
+        """
+        def captureDone(_image):
+            return self.factory.encode(self.store.append, _image.data,
+                                       time.time())
+
+        def stored(_timestamp):
+            self.captured += 1
+            _log.debug('Timelapse frame stored at {0}', _timestamp)
+
+        def captureError(_err):
+            #Errors would stop the loop, skip the frame instead
+            self.skipped += 1
+            if _err.check(TwistedPiException):
+                _log.debug('Timelapse frame skipped: {0}', _err.value.msg)
+            else:
+                _log.error('Timelapse capture failed: {0}', _err.value)
+
+        d = self.factory.coalescer.capture(dict(self.args),
+                                           Scheduler.PRIORITY_BACKGROUND,
+                                           self.interval)
+        d.addCallback(captureDone)
+        d.addCallbacks(stored, captureError)
+
+        return d
+
+    def stats(self):
+        """
+
+        :return: A dictionary with timelapse statistics
+        """
+        return dict([('interval', self.interval),
+                     ('captured', self.captured),
+                     ('skipped', self.skipped)])
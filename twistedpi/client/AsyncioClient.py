@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio client for the twistedpi server
+
+All methods return futures, so they can be awaited from coroutines::
+
+    pool = ConnectionPool('raspberrypi', 8090)
+    response = await pool.request('IMAGE', dict(resolution=[640, 480]))
+    image = response['payload']
+"""
+
+import asyncio
+import logging
+
+#twistedpi modules
+from twistedpi.client.Common import (DEFAULT_TIMEOUT, Backoff,
+                                     ConnectionClosed, ClientError,
+                                     RequestTimeout, NetstringParser,
+                                     RequestTracker, ResponseReader,
+                                     ChooseClient)
+
+
+def _resolve(_future, _response):
+    if not _future.done():
+        _future.set_result(_response)
+
+
+def _reject(_future, _exception):
+    if not _future.done():
+        _future.set_exception(_exception)
+
+
+def _chain(_source, _target):
+    #Copy the outcome of one future to another
+    def done(_future):
+        if _future.cancelled():
+            _target.cancel()
+        elif _future.exception() is not None:
+            _reject(_target, _future.exception())
+        else:
+            _resolve(_target, _future.result())
+
+    _source.add_done_callback(done)
+
+
+def _expire(_future, _timeout, _loop, _command):
+    #Fail the future with RequestTimeout if it is not done in time
+    handle = _loop.call_later(_timeout, _reject, _future,
+                              RequestTimeout(_command))
+    _future.add_done_callback(lambda _: handle.cancel())
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    A single client connection. Requests may be made before the handshake
+    has been received, they are sent once the connection is ready.
+
+    :param _loop:
+    :param _onLost: Called with the protocol when the connection is lost
+    """
+
+    def __init__(self, _loop, _onLost=None):
+        self.loop = _loop
+        self.on_lost = _onLost
+
+        self.transport = None
+        self.handshake = None
+        self.ready = _loop.create_future()
+
+        self.parser = NetstringParser()
+        self.reader = ResponseReader()
+        self.tracker = RequestTracker(self._send, _resolve, _reject)
+
+    def _send(self, _data):
+        self.transport.write(str(len(_data)).encode('ascii') + b':' + _data +
+                             b',')
+
+    def connection_made(self, _transport):
+        self.transport = _transport
+
+    def data_received(self, _data):
+        try:
+            strings = self.parser.feed(_data)
+        except ClientError as _e:
+            logging.getLogger(__name__).error('Bad response: %s', _e)
+            self.transport.close()
+            return
+
+        for string in strings:
+            response = self.reader.stringReceived(string)
+            if response is None:
+                continue
+
+            if self.handshake is None:
+                self._handshakeReceived(response)
+            else:
+                self.tracker.responseReceived(response)
+
+    def _handshakeReceived(self, _handshake):
+        self.handshake = _handshake
+
+        #Ask for raw binary payloads before any queued request goes out
+        if 'binary' in _handshake.get('transports', ()):
+            self.tracker.submit('NEGOTIATE', dict([('transport', 'binary')]),
+                                self.loop.create_future(), _first=True)
+
+        self.tracker.start(_handshake.get('max_in_flight', None))
+        _resolve(self.ready, self)
+
+    def connection_lost(self, _exc):
+        self.tracker.fail(ConnectionClosed(str(_exc)))
+        _reject(self.ready, ConnectionClosed(str(_exc)))
+
+        if self.on_lost is not None:
+            self.on_lost(self)
+
+    def request(self, _command, _args=None, _onFrame=None,
+                _timeout=DEFAULT_TIMEOUT):
+        """
+        Send a request. Cancelling the future abandons the request.
+
+        :param _command:
+        :param _args:
+        :param _onFrame: Called with every STREAM or BURST frame and CLIP
+                         chunk of the request, every node result of an
+                         aggregator request, or every message of a
+                         SUBSCRIBE request, as it arrives
+        :param _timeout: Seconds the server has to answer, or None to wait
+                         forever
+        :return: A future resolved with the response, or failing with
+                 RequestTimeout
+        """
+        future = self.loop.create_future()
+        self.tracker.submit(_command, _args, future, _onFrame)
+
+        #A cancelled or timed out request is dropped by the tracker
+        future.add_done_callback(self.tracker.abandon)
+        if _timeout is not None:
+            _expire(future, _timeout, self.loop, _command)
+
+        return future
+
+
+class Connection(object):
+    """
+    Keep a single connection open, reconnecting with exponential backoff
+    when it is lost.
+
+    :param _host:
+    :param _port:
+    :param _loop:
+    """
+
+    def __init__(self, _host, _port, _loop):
+        self.host = _host
+        self.port = _port
+        self.loop = _loop
+
+        self.client = None
+        self.closed = False
+
+        self._backoff = Backoff()
+        self._waiting = list()
+
+        self._connect()
+
+    def _connect(self):
+        if self.closed:
+            return
+
+        factory = lambda: ClientProtocol(self.loop, self._clientLost)
+        attempt = self.loop.create_task(
+            self.loop.create_connection(factory, self.host, self.port))
+        attempt.add_done_callback(self._connectDone)
+
+    def _connectDone(self, _attempt):
+        if _attempt.cancelled() or _attempt.exception() is not None:
+            self._retry()
+            return
+
+        _, client = _attempt.result()
+        client.ready.add_done_callback(self._clientReady)
+
+    def _clientReady(self, _ready):
+        if _ready.exception() is not None:
+            return
+
+        client = _ready.result()
+        if self.closed:
+            client.transport.close()
+            return
+
+        self._backoff.reset()
+        self.client = client
+
+        waiting, self._waiting = self._waiting, list()
+        for future in waiting:
+            _resolve(future, client)
+
+    def _clientLost(self, _client):
+        if self.client is _client:
+            self.client = None
+        self._retry()
+
+    def _retry(self):
+        if not self.closed:
+            self.loop.call_later(self._backoff.next(), self._connect)
+
+    def connection(self):
+        """
+
+        :return: A future resolved with a ready client, cancelling it stops
+                 the wait
+        """
+        future = self.loop.create_future()
+
+        if self.client is not None:
+            _resolve(future, self.client)
+        else:
+            self._waiting.append(future)
+            future.add_done_callback(self._forget)
+
+        return future
+
+    def _forget(self, _future):
+        if _future in self._waiting:
+            self._waiting.remove(_future)
+
+    def close(self):
+        """
+        Close the connection without reconnecting.
+        """
+        self.closed = True
+        if self.client is not None:
+            self.client.transport.close()
+
+        waiting, self._waiting = self._waiting, list()
+        for future in waiting:
+            _reject(future, ConnectionClosed('Connection closed'))
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent connections to a server. Requests go to the least
+    loaded connection. A STREAM has to be stopped on the connection that
+    started it, use ``connection`` to get hold of a single connection.
+
+    :param _host:
+    :param _port:
+    :param _size: Number of connections
+    :param _loop:
+    """
+
+    def __init__(self, _host, _port, _size=2, _loop=None):
+        self.loop = _loop if _loop is not None else asyncio.get_event_loop()
+        self.connections = [Connection(_host, _port, self.loop)
+                            for _ in range(_size)]
+
+    def request(self, _command, _args=None, _onFrame=None,
+                _timeout=DEFAULT_TIMEOUT):
+        """
+        Send a request over the least loaded connection. Cancelling the
+        future abandons the request.
+
+        :param _command:
+        :param _args:
+        :param _onFrame: Called with every STREAM or BURST frame and CLIP
+                         chunk of the request, every node result of an
+                         aggregator request, or every message of a
+                         SUBSCRIBE request, as it arrives
+        :param _timeout: Seconds the server has to answer, including the
+                         wait for a connection, or None to wait forever
+        :return: A future resolved with the response, or failing with
+                 RequestTimeout
+        """
+        future = self.loop.create_future()
+        connection = self.connection()
+
+        def connected(_connection):
+            if future.done():
+                return
+
+            if _connection.exception() is not None:
+                _reject(future, _connection.exception())
+            else:
+                request = _connection.result().request(_command, _args,
+                                                       _onFrame, None)
+                _chain(request, future)
+                future.add_done_callback(lambda _: request.cancel())
+
+        connection.add_done_callback(connected)
+        future.add_done_callback(lambda _: connection.cancel())
+
+        if _timeout is not None:
+            _expire(future, _timeout, self.loop, _command)
+
+        return future
+
+    def connection(self):
+        """
+
+        :return: A future resolved with the least loaded ready client
+        """
+        future = self.loop.create_future()
+
+        client = ChooseClient([connection.client
+                               for connection in self.connections
+                               if connection.client is not None])
+        if client is not None:
+            _resolve(future, client)
+            return future
+
+        #Use whichever connection becomes ready first, the waits on the
+        #other connections are cancelled
+        waiting = [connection.connection() for connection in self.connections]
+        for other in waiting:
+            _chain(other, future)
+
+        def cancelWaiting(_):
+            for other in waiting:
+                other.cancel()
+
+        future.add_done_callback(cancelWaiting)
+        return future
+
+    def close(self):
+        """
+        Close all connections without reconnecting.
+        """
+        for connection in self.connections:
+            connection.close()
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Protocol handling shared by the client flavors
+"""
+
+from collections import deque
+import itertools
+import json
+import random
+
+
+#Largest response accepted from a server, images can be large
+MAX_RESPONSE_LENGTH = 64 * 1024 * 1024
+
+#Time a request has to be answered by default, in seconds
+DEFAULT_TIMEOUT = 30.0
+
+
+class ClientError(Exception):
+    """
+    Base class for client errors.
+    """
+
+
+class RequestError(ClientError):
+    """
+    The server answered a request with an error.
+
+    :param _command: The command of the request
+    :param _code: The error code, see ``twistedpi.errors.ErrorCodes``
+    """
+
+    def __init__(self, _command, _code):
+        super(RequestError, self).__init__('{0} failed ({1})'.format(_command,
+                                                                    _code))
+        self.command = _command
+        self.code = _code
+
+
+class RequestTimeout(ClientError):
+    """
+    The request was not answered in time.
+
+    :param _command: The command of the request
+    """
+
+    def __init__(self, _command):
+        super(RequestTimeout, self).__init__('{0} timed out'.format(_command))
+        self.command = _command
+
+
+class ConnectionClosed(ClientError):
+    """
+    The connection was lost before the request was answered.
+    """
+
+
+def EncodeRequest(_command, _args, _id):
+    """
+
+    :param _command:
+    :param _args:
+    :param _id:
+    :return: The request as bytes
+    """
+    return json.dumps(dict([('command', _command), ('args', _args),
+                            ('id', _id)])).encode('utf-8')
+
+
+class NetstringParser(object):
+    """
+    Split received data into netstrings.
+
+    :param _maxLength: Largest accepted netstring
+    """
+
+    def __init__(self, _maxLength=MAX_RESPONSE_LENGTH):
+        self.max_length = _maxLength
+        self._buffer = b''
+
+    def feed(self, _data):
+        """
+
+        :param _data: Received bytes
+        :return: A list with the completed netstrings
+        :raise ClientError:
+        """
+        self._buffer += _data
+        strings = list()
+
+        while True:
+            colon = self._buffer.find(b':')
+            if colon < 0:
+                if len(self._buffer) > 10:
+                    raise ClientError('Invalid netstring')
+                break
+
+            length = int(self._buffer[:colon])
+            if length > self.max_length:
+                raise ClientError('Response too large')
+
+            end = colon + 1 + length
+            if len(self._buffer) < end + 1:
+                break
+            if self._buffer[end:end + 1] != b',':
+                raise ClientError('Invalid netstring')
+
+            strings.append(self._buffer[colon + 1:end])
+            self._buffer = self._buffer[end + 1:]
+
+        return strings
+
+
+class ResponseReader(object):
+    """
+    Turn received netstrings into responses. A response sent with the binary
+    transport is joined with the netstrings holding its payloads. A response
+    with several payloads lists their sizes in ``binary`` and receives a list
+    of payloads.
+    """
+
+    def __init__(self):
+        self._header = None
+        self._payloads = None
+
+    def stringReceived(self, _string):
+        """
+
+        :param _string: A received netstring
+        :return: A complete response, or None if more data is needed
+        """
+        if self._header is not None:
+            response = self._header
+
+            if not isinstance(response['binary'], list):
+                self._header = None
+                response['payload'] = _string
+                return response
+
+            self._payloads.append(_string)
+            if len(self._payloads) < len(response['binary']):
+                return None
+
+            response['payload'], self._payloads = self._payloads, None
+            self._header = None
+            return response
+
+        response = json.loads(_string.decode('utf-8'))
+        if 'binary' in response:
+            self._header = response
+            if isinstance(response['binary'], list):
+                self._payloads = list()
+            return None
+
+        return response
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter for reconnection attempts.
+
+    :param _initial: First delay in seconds
+    :param _maximum: Largest delay in seconds
+    :param _factor: Growth of the delay per attempt
+    """
+
+    def __init__(self, _initial=0.5, _maximum=30.0, _factor=2.0):
+        self.initial = _initial
+        self.maximum = _maximum
+        self.factor = _factor
+        self.delay = _initial
+
+    def next(self):
+        """
+
+        :return: The delay before the next attempt
+        """
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+
+        return delay * random.uniform(0.8, 1.2)
+
+    def reset(self):
+        """
+        Start over after a successful connection.
+        """
+        self.delay = self.initial
+
+
+class RequestTracker(object):
+    """
+    Pipeline requests over a connection and match the responses to them.
+
+    Requests get increasing ids. Requests beyond the server's in-flight limit
+    are held back until earlier ones are answered. Nothing is sent until
+    ``start`` is called, after the server handshake. Messages published on
+    a subscribed channel go to the ``_onFrame`` callable of the SUBSCRIBE
+    request until the channel is unsubscribed. The results of single nodes
+    sent by an aggregator also go to ``_onFrame``.
+
+    :param _send: Callable sending an encoded request
+    :param _resolve: Callable taking a waiter and a response
+    :param _reject: Callable taking a waiter and an exception
+    """
+
+    def __init__(self, _send, _resolve, _reject):
+        self._send = _send
+        self._resolve = _resolve
+        self._reject = _reject
+
+        self.max_in_flight = None
+        self.started = False
+
+        self._ids = itertools.count(1)
+        self._queue = deque()
+        self._pending = dict()
+        self._subscriptions = dict()
+        self._stream = None
+
+    @property
+    def in_flight(self):
+        """
+        Number of sent and queued requests not yet answered.
+        """
+        return len(self._pending) + len(self._queue)
+
+    def submit(self, _command, _args, _waiter, _onFrame=None, _first=False):
+        """
+        Queue a request.
+
+        :param _command:
+        :param _args:
+        :param _waiter: Resolved with the response
+        :param _onFrame: Called with every frame, chunk or node result
+                         pushed for the request
+        :param _first: Send before all queued requests
+        """
+        request = (next(self._ids), _command, _args or dict(), _waiter,
+                   _onFrame)
+
+        if _first:
+            self._queue.appendleft(request)
+        else:
+            self._queue.append(request)
+
+        self._flush()
+
+    def start(self, _maxInFlight=None):
+        """
+        Start sending requests.
+
+        :param _maxInFlight: The server's in-flight limit
+        """
+        self.max_in_flight = _maxInFlight
+        self.started = True
+        self._flush()
+
+    def abandon(self, _waiter):
+        """
+        Give up on a request. A queued request is dropped. A sent request
+        keeps its place until the server answers it, the answer and any
+        frames pushed for it are discarded.
+
+        :param _waiter: The waiter of the request
+        :return: True if the request was still unanswered
+        """
+        for request in self._queue:
+            if request[3] is _waiter:
+                self._queue.remove(request)
+                return True
+
+        for request_id, (command, args, waiter, onFrame) in \
+                list(self._pending.items()):
+            if waiter is _waiter:
+                if command == 'STREAM' and self._stream is onFrame:
+                    self._stream = None
+                self._pending[request_id] = (command, args, None, None)
+                return True
+
+        return False
+
+    def _flush(self):
+        while self.started and self._queue and (
+                self.max_in_flight is None or
+                len(self._pending) < self.max_in_flight):
+            request_id, command, args, waiter, onFrame = self._queue.popleft()
+
+            self._pending[request_id] = (command, args, waiter, onFrame)
+            if command == 'STREAM':
+                self._stream = onFrame
+
+            self._send(EncodeRequest(command, args, request_id))
+
+    def responseReceived(self, _response):
+        """
+
+        :param _response: A response from the server
+        """
+        request_id = _response.get('id', None)
+
+        if request_id in self._subscriptions:
+            onFrame = self._subscriptions[request_id][1]
+            if onFrame is not None:
+                onFrame(_response)
+            return
+
+        if 'frame' in _response or 'chunk' in _response or \
+                'node' in _response:
+            if _response.get('command', None) == 'STREAM':
+                onFrame = self._stream
+            else:
+                onFrame = self._pending.get(request_id, (None,) * 4)[3]
+
+            if onFrame is not None:
+                onFrame(_response)
+            return
+
+        if not request_id in self._pending:
+            #A stream that ended with an error
+            if _response.get('command', None) == 'STREAM':
+                self._stream = None
+            return
+
+        command, args, waiter, onFrame = self._pending.pop(request_id)
+
+        if 'error' in _response:
+            if waiter is not None:
+                if command == 'STREAM':
+                    self._stream = None
+                self._reject(waiter, RequestError(command,
+                                                  _response['error']['code']))
+        else:
+            if command == 'STOP_STREAM':
+                self._stream = None
+            elif command == 'SUBSCRIBE' and waiter is not None:
+                self._subscriptions[request_id] = (args.get('channel', None),
+                                                   onFrame)
+            elif command == 'UNSUBSCRIBE':
+                self._unsubscribed(args.get('channel', None))
+            if waiter is not None:
+                self._resolve(waiter, _response)
+
+        self._flush()
+
+    def _unsubscribed(self, _channel):
+        for request_id, (channel, _) in list(self._subscriptions.items()):
+            if _channel is None or channel == _channel:
+                del self._subscriptions[request_id]
+
+    def fail(self, _exception):
+        """
+        Reject every pending and queued request.
+
+        :param _exception:
+        """
+        waiters = [waiter for _, _, waiter, _ in self._pending.values()
+                   if waiter is not None]
+        waiters += [request[3] for request in self._queue]
+
+        self._pending.clear()
+        self._queue.clear()
+        self._subscriptions.clear()
+        self._stream = None
+        self.started = False
+
+        for waiter in waiters:
+            self._reject(waiter, _exception)
+
+
+def ChooseClient(_clients):
+    """
+    Pick the least loaded of the connected clients.
+
+    :param _clients: Connected clients
+    :return: A client, or None
+    """
+    if not _clients:
+        return None
+
+    return min(_clients, key=lambda _client: _client.tracker.in_flight)
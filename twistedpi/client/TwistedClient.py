@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2014 Björn Larsson
+
+# This file is part of twistedpi.
+#
+# twistedpi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twistedpi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with twistedpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Twisted client for the twistedpi server
+"""
+
+#Twisted modules
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.defer import Deferred, CancelledError, succeed
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+from twisted.python.failure import Failure
+
+import logging
+
+#twistedpi modules
+from twistedpi.client.Common import (MAX_RESPONSE_LENGTH, DEFAULT_TIMEOUT,
+                                     ConnectionClosed, RequestTimeout,
+                                     RequestTracker, ResponseReader,
+                                     ChooseClient)
+
+
+def _resolve(_waiter, _response):
+    _waiter.callback(_response)
+
+
+def _reject(_waiter, _exception):
+    _waiter.errback(_exception)
+
+
+def _expire(_d, _timeout, _clock, _command):
+    #Cancel the Deferred and fail it with RequestTimeout if it has not fired
+    #in time
+    expired = list()
+
+    def timedOut():
+        expired.append(True)
+        _d.cancel()
+
+    call = _clock.callLater(_timeout, timedOut)
+
+    def done(_result):
+        if call.active():
+            call.cancel()
+        elif expired and isinstance(_result, Failure) and \
+                _result.check(CancelledError):
+            return Failure(RequestTimeout(_command))
+        return _result
+
+    _d.addBoth(done)
+
+
+class ClientProtocol(NetstringReceiver):
+    """
+    A single client connection. Requests may be made before the handshake
+    has been received, they are sent once the connection is ready.
+    """
+    MAX_LENGTH = MAX_RESPONSE_LENGTH
+
+    def __init__(self):
+        from twisted.internet import reactor
+
+        self.clock = reactor
+        self.handshake = None
+        self.ready = Deferred()
+
+        self.reader = ResponseReader()
+        self.tracker = RequestTracker(self.sendString, _resolve, _reject)
+
+    def stringReceived(self, _string):
+        response = self.reader.stringReceived(_string)
+        if response is None:
+            return
+
+        if self.handshake is None:
+            self._handshakeReceived(response)
+        else:
+            self.tracker.responseReceived(response)
+
+    def _handshakeReceived(self, _handshake):
+        log.msg('Connected to {0} {1}'.format(_handshake.get('name', None),
+                                             _handshake.get('version', None)),
+                logLevel=logging.DEBUG)
+        self.handshake = _handshake
+
+        #Ask for raw binary payloads before any queued request goes out
+        if 'binary' in _handshake.get('transports', ()):
+            d = Deferred()
+            d.addErrback(log.err)
+            self.tracker.submit('NEGOTIATE', dict([('transport', 'binary')]),
+                                d, _first=True)
+
+        self.tracker.start(_handshake.get('max_in_flight', None))
+        self.ready.callback(self)
+
+    def connectionLost(self, _reason):
+        self.tracker.fail(ConnectionClosed(str(_reason.value)))
+
+        if self.factory is not None:
+            self.factory.clientLost(self)
+
+    def request(self, _command, _args=None, _onFrame=None,
+                _timeout=DEFAULT_TIMEOUT):
+        """
+        Send a request. Cancelling the Deferred abandons the request.
+
+        :param _command:
+        :param _args:
+        :param _onFrame: Called with every STREAM or BURST frame and CLIP
+                         chunk of the request, every node result of an
+                         aggregator request, or every message of a
+                         SUBSCRIBE request, as it arrives
+        :param _timeout: Seconds the server has to answer, or None to wait
+                         forever
+        :return: A Deferred firing with the response, or failing with
+                 RequestTimeout
+        """
+        d = Deferred(self.tracker.abandon)
+        self.tracker.submit(_command, _args, d, _onFrame)
+
+        if _timeout is not None:
+            _expire(d, _timeout, self.clock, _command)
+
+        return d
+
+
+class ClientFactory(ReconnectingClientFactory):
+    """
+    Keep a single connection open, reconnecting with exponential backoff
+    when it is lost.
+    """
+    protocol = ClientProtocol
+    maxDelay = 30
+
+    def __init__(self, _reactor=None):
+        if _reactor is None:
+            from twisted.internet import reactor as _reactor
+
+        self.reactor = _reactor
+        self.client = None
+        self._waiting = list()
+
+    def buildProtocol(self, _addr):
+        client = ReconnectingClientFactory.buildProtocol(self, _addr)
+        client.clock = self.reactor
+        client.ready.addCallback(self._clientReady)
+        return client
+
+    def _clientReady(self, _client):
+        self.resetDelay()
+        self.client = _client
+
+        waiting, self._waiting = self._waiting, list()
+        for d in waiting:
+            d.callback(_client)
+
+    def clientLost(self, _client):
+        """
+        Called by a protocol when its connection is lost.
+
+        :param _client:
+        """
+        if self.client is _client:
+            self.client = None
+
+    def connection(self):
+        """
+
+        :return: A Deferred firing with a ready client, cancelling it stops
+                 the wait
+        """
+        if self.client is not None:
+            return succeed(self.client)
+
+        d = Deferred(self._forget)
+        self._waiting.append(d)
+        return d
+
+    def _forget(self, _d):
+        if _d in self._waiting:
+            self._waiting.remove(_d)
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent connections to a server. Requests go to the least
+    loaded connection. A STREAM has to be stopped on the connection that
+    started it, use ``connection`` to get hold of a single connection.
+
+    :param _host:
+    :param _port:
+    :param _size: Number of connections
+    :param _reactor:
+    """
+
+    def __init__(self, _host, _port, _size=2, _reactor=None):
+        if _reactor is None:
+            from twisted.internet import reactor as _reactor
+
+        self.reactor = _reactor
+        self.factories = [ClientFactory(_reactor) for _ in range(_size)]
+        for factory in self.factories:
+            _reactor.connectTCP(_host, _port, factory)
+
+    def _connected(self):
+        return [factory.client for factory in self.factories
+                if factory.client is not None]
+
+    def request(self, _command, _args=None, _onFrame=None,
+                _timeout=DEFAULT_TIMEOUT):
+        """
+        Send a request over the least loaded connection. Cancelling the
+        Deferred abandons the request.
+
+        :param _command:
+        :param _args:
+        :param _onFrame: Called with every STREAM or BURST frame and CLIP
+                         chunk of the request, every node result of an
+                         aggregator request, or every message of a
+                         SUBSCRIBE request, as it arrives
+        :param _timeout: Seconds the server has to answer, including the
+                         wait for a connection, or None to wait forever
+        :return: A Deferred firing with the response, or failing with
+                 RequestTimeout
+        """
+        d = self.connection()
+        d.addCallback(lambda _client: _client.request(_command, _args,
+                                                      _onFrame, None))
+
+        if _timeout is not None:
+            _expire(d, _timeout, self.reactor, _command)
+
+        return d
+
+    def connection(self):
+        """
+
+        :return: A Deferred firing with the least loaded ready client,
+                 cancelling it stops the wait
+        """
+        client = ChooseClient(self._connected())
+        if client is not None:
+            return succeed(client)
+
+        #Use whichever connection becomes ready first, the waits on the
+        #other connections are cancelled
+        waiting = [factory.connection() for factory in self.factories]
+
+        def cancelWaiting(_):
+            for other in waiting:
+                if not other.called:
+                    other.cancel()
+
+        d = Deferred(cancelWaiting)
+
+        def ready(_client):
+            if not d.called:
+                cancelWaiting(None)
+                d.callback(_client)
+
+        for other in waiting:
+            other.addCallback(ready)
+            other.addErrback(lambda _failure: _failure.trap(CancelledError))
+
+        return d
+
+    def close(self):
+        """
+        Close all connections without reconnecting.
+        """
+        for factory in self.factories:
+            factory.stopTrying()
+            if factory.client is not None:
+                factory.client.transport.loseConnection()
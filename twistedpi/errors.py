@@ -21,8 +21,6 @@
 Error module
 """
 
-from twisted.python import log
-
 
 class ErrorCodes(object):
     BAD_REQUEST = 1
@@ -30,13 +28,14 @@ class ErrorCodes(object):
     BAD_DATA = 3
     SERVER_ERROR = 4
     INVALID_CAMERA_ARGUMENT = 5
+    TOO_MANY_REQUESTS = 6
+    BUSY = 7
+    NOT_FOUND = 8
 
 class TwistedPiException(Exception):
     def __init__(self, _msg, _code):
-        log.err('{0}({1})'.format(_msg, _code))
-
         self.msg = _msg
-        seld.code = _code
+        self.code = _code
 
 class TwistedPiMethodNotFound(TwistedPiException):
     def __init__(self, _msg, _code, _name):